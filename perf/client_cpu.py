@@ -0,0 +1,55 @@
+import time
+
+import portal
+
+
+def main():
+
+  idle = 10
+  busy = 1
+  duration = 5
+
+  def server(port):
+    server = portal.ServerSocket(port, logging=False)
+    while True:
+      addr, data = server.recv()
+      server.send(addr, data)
+
+  def client(port):
+    # CPU usage of connected clients that do not send anything.
+    clients = [portal.ClientSocket(port, logging=False) for _ in range(idle)]
+    [x.connect() for x in clients]
+    time.sleep(1)
+    start, cpu = time.time(), time.process_time()
+    time.sleep(duration)
+    usage = (time.process_time() - cpu) / (time.time() - start)
+    print(f'idle: {100 * usage / idle:.2f}% CPU per client')
+    [x.close() for x in clients]
+
+    # CPU usage of clients that send requests in a loop, including the time
+    # spent in the calling thread.
+    clients = [portal.ClientSocket(port, logging=False) for _ in range(busy)]
+    [x.connect() for x in clients]
+    count = 0
+    start, cpu = time.time(), time.process_time()
+    while time.time() - start < duration:
+      for x in clients:
+        x.send(b'foo')
+      for x in clients:
+        assert x.recv() == b'foo'
+      count += busy
+    usage = (time.process_time() - cpu) / (time.time() - start)
+    rate = count / (time.time() - start)
+    print(f'busy: {100 * usage / busy:.2f}% CPU per client ({rate:.0f} msg/s)')
+    [x.close() for x in clients]
+
+  portal.setup(host='localhost')
+  port = portal.free_port()
+  portal.run([
+      portal.Process(server, port),
+      portal.Process(client, port),
+  ], 3 * duration)
+
+
+if __name__ == '__main__':
+  main()
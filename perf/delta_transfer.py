@@ -0,0 +1,53 @@
+import time
+
+import numpy as np
+import portal
+
+
+def main():
+
+  size = 64 * 1024 ** 2
+  repeats = 20
+  rates = (0.01, 0.1, 1.0)
+
+  # Bytes on the wire: rewrite a contiguous fraction of the parameters
+  # between consecutive messages, like a learner that updates some layers.
+  for rate in rates:
+    for delta in (False, True):
+      encoder = delta and portal.packlib.DeltaEncoder()
+      decoder = portal.packlib.DeltaDecoder()
+      params = np.zeros(size // 4, np.float32)
+      sizes = []
+      for i in range(repeats):
+        params[:int(rate * len(params))] += 1
+        buffers = portal.pack(params, delta=encoder or None)
+        portal.unpack(b''.join(buffers), delta=decoder)
+        sizes.append(sum(len(x) for x in buffers))
+      mib = np.mean(sizes[1:]) / 1024 ** 2
+      print(
+          f'rate={rate:<4}  delta={str(delta):<5}  {mib:8.2f} MiB per message')
+
+  # End-to-end latency of a call that sends the parameters to a server.
+  port = portal.free_port()
+  server = portal.Server(port)
+  server.bind('update', lambda x: x.size)
+  server.start(block=False)
+  for rate in rates:
+    for delta in (False, True):
+      client = portal.Client(port, delta=delta)
+      params = np.zeros(size // 4, np.float32)
+      client.update(params).result()
+      durations = []
+      for i in range(repeats):
+        params[:int(rate * len(params))] += 1
+        start = time.perf_counter()
+        client.update(params).result()
+        durations.append(time.perf_counter() - start)
+      client.close()
+      ms = 1000 * np.median(durations)
+      print(f'rate={rate:<4}  delta={str(delta):<5}  {ms:8.2f} ms per call')
+  server.close()
+
+
+if __name__ == '__main__':
+  main()
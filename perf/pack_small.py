@@ -0,0 +1,23 @@
+import timeit
+
+import portal
+
+
+def main():
+
+  args = (12345, 0.5, 'train', None)
+  number = 100000
+
+  for inline in (False, True):
+    def roundtrip():
+      buffers = portal.pack(args, offset=16, inline=inline)
+      portal.unpack(b''.join(buffers))
+    dur = timeit.timeit(roundtrip, number=number) / number
+    size = sum(len(x) for x in portal.pack(args, offset=16, inline=inline))
+    print(
+        f'inline={str(inline):<5}  {1e6 * dur:6.2f}us per round trip  ' +
+        f'{size} bytes')
+
+
+if __name__ == '__main__':
+  main()
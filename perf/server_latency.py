@@ -1,4 +1,6 @@
 import collections
+import os
+import tempfile
 import time
 
 import portal
@@ -7,6 +9,8 @@ import portal
 def main():
 
   size = 1024
+  duration = 10
+  transports = ('tcp', 'unix', 'shm')
 
   def server(port):
     server = portal.Server(port)
@@ -16,7 +20,7 @@ def main():
     server.bind('foo', fn)
     server.start(block=True)
 
-  def client(port):
+  def client(port, transport):
     data = bytearray(size)
     client = portal.Client(port)
     futures = collections.deque()
@@ -29,14 +33,19 @@ def main():
       end = time.perf_counter()
       durations.append(end - start)
       ping = sum(durations) / len(durations)
-      print(1000 * ping)  # <1ms
+      print(transport, 1000 * ping)  # <1ms
 
   portal.setup(host='localhost')
-  port = portal.free_port()
-  portal.run([
-      portal.Process(server, port),
-      portal.Process(client, port),
-  ])
+  for transport in transports:
+    if transport == 'tcp':
+      port = portal.free_port()
+    else:
+      path = os.path.join(tempfile.gettempdir(), 'latency.sock')
+      port = f'{transport}://{path}'
+    portal.run([
+        portal.Process(server, port),
+        portal.Process(client, port, transport),
+    ], duration)
 
 
 if __name__ == '__main__':
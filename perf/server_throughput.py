@@ -1,6 +1,7 @@
 import collections
 import time
 
+import numpy as np
 import portal
 
 
@@ -9,21 +10,31 @@ def main():
   size = 1024 ** 3 // 4
   prefetch = 8
   twoway = False
+  compress = None  # 'zlib', 'lzma', 'bz2', 'lz4', 'zstd'
+  compressible = True
+  duration = 20
+  # Large requests are striped over multiple connections of the client.
+  streams = (1, 2, 4)
 
   def server(port):
-    server = portal.Server(port)
+    server = portal.Server(port, compress=compress)
     # server = portal.BatchServer(port)
     # server = portal.BatchServer(port, process=False)
     # server = portal.BatchServer(port, shmem=True)
     def fn(x):
-      assert len(x) == size
+      assert x.nbytes == size
       return x if twoway else b'ok'
     server.bind('foo', fn)
     server.start(block=True)
 
-  def client(port):
-    data = bytearray(size)
-    client = portal.Client(port, maxinflight=prefetch + 1)
+  def client(port, streams):
+    if compressible:
+      data = np.tile(np.arange(1024, dtype=np.float32), size // 4096)
+    else:
+      data = np.random.default_rng(0).integers(0, 256, size, np.uint8)
+    assert data.nbytes == size
+    client = portal.Client(
+        port, maxinflight=prefetch + 1, compress=compress, streams=streams)
     futures = collections.deque()
     for _ in range(prefetch):
       futures.append(client.call('foo', data))
@@ -42,14 +53,15 @@ def main():
       avgdur = sum(durations) / len(durations)
       mbps = size / avgdur / (1024 ** 2)
       mbps *= 2 if twoway else 1
-      print(mbps)  # 3700 oneway, 3000 twoway
+      print(f'streams={streams}', mbps)  # 3700 oneway, 3000 twoway
 
   portal.setup(host='localhost')
-  port = portal.free_port()
-  portal.run([
-      portal.Process(server, port),
-      portal.Process(client, port),
-  ])
+  for count in streams:
+    port = portal.free_port()
+    portal.run([
+        portal.Process(server, port),
+        portal.Process(client, port, count),
+    ], duration)
 
 
 if __name__ == '__main__':
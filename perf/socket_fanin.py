@@ -0,0 +1,48 @@
+import time
+
+import portal
+
+
+def main():
+
+  size = 1024 ** 2
+  clients = 16
+  prefetch = 4
+  duration = 20
+  loops = (1, 2, 4)
+
+  def server(port, loops):
+    server = portal.ServerSocket(port, loops=loops, logging=False)
+    received = 0
+    start = time.time()
+    while True:
+      addr, data = server.recv()
+      assert len(data) == size
+      server.send(addr, b'ok')
+      received += len(data)
+      if time.time() - start >= 1:
+        mbps = received / (time.time() - start) / (1024 ** 2)
+        print(f'loops={loops}', mbps)
+        received = 0
+        start = time.time()
+
+  def client(port):
+    data = bytearray(size)
+    client = portal.ClientSocket(port, logging=False)
+    for _ in range(prefetch):
+      client.send(data)
+    while True:
+      assert client.recv() == b'ok'
+      client.send(data)
+
+  portal.setup(host='localhost')
+  for count in loops:
+    port = portal.free_port()
+    portal.run([
+        portal.Process(server, port, count),
+        *[portal.Process(client, port) for _ in range(clients)],
+    ], duration)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,61 @@
+import socket
+import time
+
+import portal
+
+
+def main():
+
+  size = 64
+  idle = 10000
+  busy = 10
+  burst = 64
+  duration = 30
+
+  def server(port):
+    server = portal.ServerSocket(port, logging=False)
+    while True:
+      addr, data = server.recv()
+      server.send(addr, data)
+
+  def idler(port, ready):
+    socks = []
+    for _ in range(idle):
+      socks.append(socket.create_connection(('localhost', port)))
+    ready.set()
+    while True:
+      time.sleep(1)
+
+  def client(port, ready):
+    ready.wait()
+    data = bytes(size)
+    clients = [
+        portal.ClientSocket(port, max_send_queue=burst, logging=False)
+        for _ in range(busy)]
+    count = 0
+    start = time.time()
+    while True:
+      for client in clients:
+        for _ in range(burst):
+          client.send(data)
+      for client in clients:
+        for _ in range(burst):
+          assert len(client.recv()) == size
+      count += busy * burst
+      if time.time() - start >= 1:
+        print(count / (time.time() - start))  # Messages per second.
+        count = 0
+        start = time.time()
+
+  portal.setup(host='localhost')
+  port = portal.free_port()
+  ready = portal.context.mp.Event()
+  portal.run([
+      portal.Process(server, port),
+      portal.Process(idler, port, ready),
+      portal.Process(client, port, ready),
+  ], duration)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,4 +1,6 @@
 import collections
+import os
+import tempfile
 import time
 
 import portal
@@ -8,6 +10,8 @@ def main():
 
   size = 1024
   parts = 32
+  duration = 10
+  transports = ('tcp', 'unix')
 
   def server(port):
     server = portal.ServerSocket(port)
@@ -16,7 +20,7 @@ def main():
       server.send(addr, b'ok')
       assert len(data) == size // parts * parts
 
-  def client(port):
+  def client(port, transport):
     data = [bytearray(size // parts) for _ in range(parts)]
     client = portal.ClientSocket(port)
     durations = collections.deque(maxlen=10)
@@ -27,17 +31,19 @@ def main():
       end = time.perf_counter()
       durations.append(end - start)
       ping = sum(durations) / len(durations)
-      print(1000 * ping)  # <1ms
+      print(transport, 1000 * ping)  # <1ms
 
   portal.setup(host='localhost')
-  port = portal.free_port()
-  portal.run([
-      portal.Process(server, port),
-      portal.Process(client, port),
-  ])
-
+  for transport in transports:
+    if transport == 'unix':
+      port = 'unix://' + os.path.join(tempfile.gettempdir(), 'latency.sock')
+    else:
+      port = portal.free_port()
+    portal.run([
+        portal.Process(server, port),
+        portal.Process(client, port, transport),
+    ], duration)
 
 
 if __name__ == '__main__':
   main()
-
@@ -0,0 +1,45 @@
+import time
+
+import portal
+
+
+def main():
+
+  size = 64
+  burst = 256
+  duration = 10
+
+  def server(port):
+    server = portal.ServerSocket(port, logging=False)
+    while True:
+      addr, data = server.recv()
+      assert len(data) == size
+      server.send(addr, data)
+
+  def client(port):
+    data = bytes(size)
+    client = portal.ClientSocket(
+        port, max_send_queue=burst, max_recv_queue=burst, logging=False)
+    count = 0
+    start = time.time()
+    while True:
+      for _ in range(burst):
+        client.send(data)
+      for _ in range(burst):
+        assert len(client.recv()) == size
+      count += burst
+      if time.time() - start >= 1:
+        print(count / (time.time() - start))  # Messages per second.
+        count = 0
+        start = time.time()
+
+  portal.setup(host='localhost')
+  port = portal.free_port()
+  portal.run([
+      portal.Process(server, port),
+      portal.Process(client, port),
+  ], duration)
+
+
+if __name__ == '__main__':
+  main()
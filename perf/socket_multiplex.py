@@ -0,0 +1,55 @@
+import collections
+import time
+
+import numpy as np
+import portal
+
+
+def main():
+
+  size = 1024 ** 3 // 4
+  prefetch = 2
+  duration = 10
+  chunk_sizes = (0, 256 * 1024)
+
+  def server(port, chunk_size):
+    server = portal.ServerSocket(port, chunk_size=chunk_size)
+    while True:
+      addr, data = server.recv()
+      server.send(addr, bytes(data[:4]))
+
+  def client(port, chunk_size):
+    # Small pings are sent on the same connection while large messages are
+    # queued in front of them. On a single CPU, this measured a mean of
+    # 252 ms without chunks and 5.4 ms with 256 KiB chunks, short of
+    # sub-millisecond latency, because pings still wait for the bytes in the
+    # kernel socket buffers and for the scheduler.
+    bulk = bytearray(size)
+    bulk[:4] = b'bulk'
+    client = portal.ClientSocket(port, chunk_size=chunk_size)
+    durations = collections.deque(maxlen=100)
+    inflight = 0
+    while True:
+      while inflight < prefetch:
+        client.send(bulk)
+        inflight += 1
+      start = time.perf_counter()
+      client.send(b'ping')
+      while bytes(client.recv()) != b'ping':
+        inflight -= 1
+      durations.append(time.perf_counter() - start)
+      mean = 1000 * np.mean(durations)
+      p99 = 1000 * np.percentile(durations, 99)
+      print(f'chunk_size={chunk_size} mean={mean:.2f}ms p99={p99:.2f}ms')
+
+  portal.setup(host='localhost')
+  for chunk_size in chunk_sizes:
+    port = portal.free_port()
+    portal.run([
+        portal.Process(server, port, chunk_size),
+        portal.Process(client, port, chunk_size),
+    ], duration)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,4 +1,6 @@
 import collections
+import os
+import tempfile
 import time
 
 import portal
@@ -10,10 +12,12 @@ def main():
   parts = 64
   prefetch = 8
   twoway = False
+  duration = 20
+  transports = ('tcp', 'unix', 'zerocopy')
   assert size % parts == 0
 
-  def server(port):
-    server = portal.ServerSocket(port)
+  def server(port, transport):
+    server = portal.ServerSocket(port, zerocopy=(transport == 'zerocopy'))
     while True:
       addr, data = server.recv()
       if twoway:
@@ -22,13 +26,15 @@ def main():
         server.send(addr, b'ok')
       assert len(data) == size
 
-  def client(port):
+  def client(port, transport):
     data = [bytearray(size // parts) for _ in range(parts)]
-    client = portal.ClientSocket(port)
+    client = portal.ClientSocket(port, zerocopy=(transport == 'zerocopy'))
     for _ in range(prefetch):
       client.send(*data)
     durations = collections.deque(maxlen=50)
+    cputimes = collections.deque(maxlen=50)
     start = time.time()
+    cpu = time.process_time()
     while True:
       client.send(*data)
       result = client.recv()
@@ -36,20 +42,27 @@ def main():
         assert len(result) == size
       else:
         assert result == b'ok'
-      end = time.time()
+      end, now = time.time(), time.process_time()
       durations.append(end - start)
-      start = end
+      cputimes.append(now - cpu)
+      start, cpu = end, now
       avgdur = sum(durations) / len(durations)
       mbps = size / avgdur / (1024 ** 2)
       mbps *= 2 if twoway else 1
-      print(mbps)  # 3500 oneway, 2500 twoway
+      # CPU time of the client process including its socket thread.
+      usage = sum(cputimes) / sum(durations)
+      print(transport, mbps, f'{100 * usage:.0f}% CPU')
 
   portal.setup(host='localhost')
-  port = portal.free_port()
-  portal.run([
-      portal.Process(server, port),
-      portal.Process(client, port),
-  ])
+  for transport in transports:
+    if transport == 'unix':
+      port = 'unix://' + os.path.join(tempfile.gettempdir(), 'throughput.sock')
+    else:
+      port = portal.free_port()
+    portal.run([
+        portal.Process(server, port, transport),
+        portal.Process(client, port, transport),
+    ], duration)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,45 @@
+import timeit
+
+import numpy as np
+import portal
+
+
+def recursive_flatten(tree):
+  leaves = []
+  portal.packlib.tree_map(lambda x: leaves.append(x), tree)
+  structure = portal.packlib.tree_map(lambda x: None, tree)
+  return tuple(leaves), structure
+
+
+def recursive_unflatten(leaves, structure):
+  leaves = iter(tuple(leaves))
+  return portal.packlib.tree_map(lambda x: next(leaves), structure)
+
+
+def main():
+
+  wide = {
+      f'layer{i}': {'kernel': np.zeros(4), 'bias': np.zeros(4)}
+      for i in range(5000)}
+  deep = np.zeros(4)
+  for i in range(200):
+    deep = {'inner': deep, 'extra': [np.zeros(4), np.zeros(4)]}
+
+  for name, tree in [('wide', wide), ('deep', deep)]:
+    for impl, flatten, unflatten in [
+        ('recursive', recursive_flatten, recursive_unflatten),
+        ('iterative', portal.packlib.tree_flatten,
+         portal.packlib.tree_unflatten),
+    ]:
+      leaves, structure = flatten(tree)
+      number = 20
+      dur1 = timeit.timeit(lambda: flatten(tree), number=number) / number
+      dur2 = timeit.timeit(
+          lambda: unflatten(leaves, structure), number=number) / number
+      print(
+          f'{name:<5} {impl:<10} {len(leaves):>6} leaves  ' +
+          f'flatten {1000 * dur1:7.3f}ms  unflatten {1000 * dur2:7.3f}ms')
+
+
+if __name__ == '__main__':
+  main()
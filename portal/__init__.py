@@ -17,12 +17,17 @@ from .process import Process
 from .server_socket import ServerSocket
 from .client_socket import ClientSocket
 from .client_socket import Disconnected
+from .shmem_socket import ShmemServerSocket
+from .shmem_socket import ShmemClientSocket
 
 from .client import Client
 from .server import Server
 from .batching import BatchServer
+from .aio import AsyncClient
+from .aio import AsyncServer
 
 from .packlib import pack
+from .packlib import pack_into
 from .packlib import unpack
 from .packlib import tree_equals
 
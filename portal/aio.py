@@ -0,0 +1,486 @@
+import asyncio
+import functools
+import inspect
+import itertools
+import os
+import socket
+import types
+import weakref
+
+from . import buffers
+from . import client
+from . import client_socket
+from . import contextlib
+from . import packlib
+from . import server
+from . import server_socket
+from . import utils
+
+
+class Protocol(asyncio.BufferedProtocol):
+
+  """
+  Reads messages with the same length prefix that the socket classes use,
+  directly into aligned buffers that arrays can be unpacked from without
+  copying. Chunk frames are reassembled into the buffer of their message.
+  """
+
+  def __init__(self, maxsize, recv, conn=None, disc=None):
+    self.maxsize = maxsize
+    self.callbacks = (recv, conn, disc)
+    self.transport = None
+    self.lenbuf = memoryview(bytearray(buffers.CHUNK.size))
+    self.headsize = 4
+    self.buffer = None
+    self.pos = 0
+    self.stream = None
+    self.partials = {}  # {stream: [buffer, filled]}
+    self.drained = None
+
+  @property
+  def closing(self):
+    return not self.transport or self.transport.is_closing()
+
+  def send(self, *data):
+    data = [x.cast('c') if isinstance(x, memoryview) else x for x in data]
+    length = sum(len(x) for x in data)
+    assert 1 <= length <= self.maxsize, (length, self.maxsize)
+    self.transport.writelines([length.to_bytes(4, 'little'), *data])
+
+  async def drain(self):
+    if self.drained:
+      await asyncio.shield(self.drained)
+
+  def connection_made(self, transport):
+    self.transport = transport
+    conn = self.callbacks[1]
+    conn and conn(self)
+
+  def connection_lost(self, exc):
+    self.resume_writing()
+    disc = self.callbacks[2]
+    disc and disc(self, exc)
+
+  def pause_writing(self):
+    self.drained = asyncio.get_running_loop().create_future()
+
+  def resume_writing(self):
+    if self.drained:
+      self.drained.done() or self.drained.set_result(None)
+      self.drained = None
+
+  def get_buffer(self, sizehint):
+    if self.buffer is None:
+      return self.lenbuf[self.pos: self.headsize]
+    return self.buffer[self.pos:]
+
+  def buffer_updated(self, nbytes):
+    self.pos += nbytes
+    if self.buffer is None:
+      if self.pos < self.headsize:
+        return
+      length = int.from_bytes(self.lenbuf[:4], 'little', signed=False)
+      if not length and self.headsize == 4:
+        # Read the rest of the chunk header.
+        self.headsize = buffers.CHUNK.size
+        return
+      if self.headsize == 4:
+        if not 1 <= length <= self.maxsize:
+          self.transport.abort()
+          return
+        self.buffer = self._allocate(length)
+      else:
+        _, stream, length, total = buffers.CHUNK.unpack(self.lenbuf)
+        self.buffer = self._target(stream, length, total)
+        if self.buffer is None:
+          self.transport.abort()
+          return
+        self.stream = stream
+      self.headsize = 4
+      self.pos = 0
+    elif self.pos == len(self.buffer):
+      buffer, self.buffer, self.pos = self.buffer, None, 0
+      stream, self.stream = self.stream, None
+      if stream is not None:
+        partial = self.partials[stream]
+        partial[1] += len(buffer)
+        if partial[1] < len(partial[0]):
+          return
+        buffer = self.partials.pop(stream)[0]
+      self.callbacks[0](self, buffer)
+
+  def _allocate(self, length):
+    arr = buffers.empty(length)
+    buffer = memoryview(arr.data)
+    weakref.finalize(buffer, lambda arr=arr: arr)
+    return buffer
+
+  def _target(self, stream, length, total):
+    # Returns the part of the message buffer that the chunk is received into,
+    # or None if the chunk does not fit the message.
+    partial = self.partials.get(stream)
+    if partial is None:
+      if not 1 <= total <= self.maxsize:
+        return None
+      partial = self.partials[stream] = [self._allocate(total), 0]
+    message, filled = partial
+    if not 1 <= length <= len(message) - filled:
+      return None
+    return message[filled: filled + length]
+
+
+class AsyncClient:
+
+  """
+  Client for use inside an asyncio event loop that speaks the same protocol
+  as `Client`. Calls are coroutines that resolve to the result, so many
+  requests can be in flight concurrently without a thread for each of them.
+  """
+
+  def __init__(
+      self, addr, name='Client', maxinflight=16, compress=None,
+      compress_min=packlib.COMPRESS_MIN_SIZE, delta=False,
+      version=packlib.VERSION, **kwargs):
+    addr = str(addr)
+    assert 1 <= maxinflight, maxinflight
+    assert compress is None or compress in packlib.CODECS, compress
+    assert not addr.startswith('shm://'), 'Shared memory is not supported'
+    self.name = name
+    self.options = client_socket.Options(
+        **{**contextlib.context.clientkw, **kwargs})
+    self.path = None
+    if addr.startswith('unix://'):
+      self.path = addr[len('unix://'):]
+      self.addr = (self.path, '')
+    else:
+      assert '://' not in addr, addr
+      host, port = addr.rsplit(':', 1) if ':' in addr else ('', addr)
+      host = host or ('::1' if self.options.ipv6 else '127.0.0.1')
+      self.addr = (host, port)
+    self.maxinflight = maxinflight
+    # Packing and sending happen without awaiting in between, so requests
+    # reach the server in the order their deltas were encoded.
+    self.delta = delta and packlib.DeltaEncoder()
+    self.packkw = dict(
+        compress=compress, compress_min=compress_min,
+        delta=self.delta or None, version=version)
+    self.names = {}
+    self.reqnum = iter(itertools.count(0))
+    self.futures = {}
+    self.slots = None
+    self.protocol = None
+    self.connecting = None
+
+  @property
+  def connected(self):
+    return bool(self.protocol) and not self.protocol.closing
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    try:
+      return functools.partial(self.call, name)
+    except AttributeError:
+      raise ValueError(name)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *e):
+    await self.close()
+
+  async def connect(self, timeout=None):
+    if self.connected:
+      return True
+    if not self.connecting:
+      self.connecting = asyncio.ensure_future(self._connect())
+    try:
+      await asyncio.wait_for(asyncio.shield(self.connecting), timeout)
+      return True
+    except asyncio.TimeoutError:
+      return False
+
+  async def call(self, method, *data):
+    if not self.slots:
+      self.slots = asyncio.Semaphore(self.maxinflight)
+    async with self.slots:
+      if not self.connected:
+        if not self.options.autoconn:
+          raise client_socket.Disconnected
+        await self.connect()
+      reqnum = next(self.reqnum)
+      name = self.names.get(method)
+      if name is None:
+        name = self.names[method] = method.encode('utf-8')
+      # The transport may hold on to the buffers after the call returns, so
+      # the header is written into a new block for every request.
+      offset = client.PREFIX.size + len(name)
+      block = bytearray(offset)
+      client.PREFIX.pack_into(block, 0, reqnum, len(name))
+      block[client.PREFIX.size:] = name
+      sendargs = packlib.pack_into(block, data, offset, **self.packkw)
+      future = asyncio.get_running_loop().create_future()
+      self.futures[reqnum] = future
+      try:
+        self.protocol.send(*sendargs)
+        await self.protocol.drain()
+        return await future
+      finally:
+        self.futures.pop(reqnum, None)
+
+  async def close(self):
+    self._fail()
+    if self.connecting:
+      self.connecting.cancel()
+    if self.protocol:
+      self.protocol.transport.close()
+      self.protocol = None
+
+  async def _connect(self):
+    if self.path:
+      self._log(f'Connecting to unix://{self.path}')
+    else:
+      self._log(f'Connecting to {self.addr[0]}:{self.addr[1]}')
+    loop = asyncio.get_running_loop()
+    factory = functools.partial(
+        Protocol, self.options.max_msg_size, self._recv, disc=self._disc)
+    once = True
+    while True:
+      try:
+        if self.path:
+          _, protocol = await loop.create_unix_connection(factory, self.path)
+        else:
+          # We need to resolve the address regularly.
+          host, port = self.addr
+          if contextlib.context.resolver:
+            host, port = contextlib.context.resolver((host, port))
+            assert isinstance(host, str), (host, port)
+          _, protocol = await loop.create_connection(factory, host, int(port))
+        break
+      except OSError as e:
+        # For example ConnectionRefusedError, socket.gaierror, or
+        # FileNotFoundError if the server has not created its socket yet.
+        if once:
+          self._log(f'Still trying to connect... ({e})')
+          once = False
+        await asyncio.sleep(self.options.connect_wait)
+    self._log('Connection established')
+    if self.delta:
+      # The server may have restarted and lost the delta references, so new
+      # requests start from full arrays again.
+      self.delta.reset()
+    self.protocol = protocol
+    self.connecting = None
+
+  def _recv(self, protocol, data):
+    assert len(data) >= 16, 'Unexpectedly short response'
+    reqnum, status = client.PREFIX.unpack(data[:16])
+    future = self.futures.pop(reqnum, None)
+    if not future or future.done():
+      return  # The call was cancelled.
+    if status == 0:
+      try:
+        future.set_result(packlib.unpack(data[16:]))
+      except Exception as e:
+        future.set_exception(e)
+    else:
+      message = bytes(data[16:]).decode('utf-8')
+      future.set_exception(RuntimeError(message))
+
+  def _disc(self, protocol, exc):
+    if protocol is not self.protocol:
+      return
+    detail = exc and f'{type(exc).__name__}: {exc}'
+    self._log(f'Connection to server lost ({detail or "closed"})')
+    self.protocol = None
+    # Requests are not resent after reconnecting, because they cannot be
+    # awaited from the same call anymore.
+    self._fail()
+
+  def _fail(self):
+    for future in self.futures.values():
+      future.done() or future.set_exception(client_socket.Disconnected())
+    self.futures.clear()
+
+  def _log(self, *args):
+    if not self.options.logging:
+      return
+    contextlib.context.print(
+        self.name, *args, color=self.options.logging_color)
+
+
+class AsyncServer:
+
+  """
+  Server for use inside an asyncio event loop that speaks the same protocol
+  as `Server`. Bound functions can be coroutine functions, which run
+  concurrently for all requests. Regular functions are called directly on the
+  event loop and should thus return quickly.
+  """
+
+  def __init__(
+      self, port, name='Server', errors=True, compress=None,
+      compress_min=packlib.COMPRESS_MIN_SIZE, version=packlib.VERSION,
+      **kwargs):
+    assert compress is None or compress in packlib.CODECS, compress
+    self.path = None
+    if isinstance(port, str) and port.startswith('unix://'):
+      self.path = port[len('unix://'):]
+    elif isinstance(port, str):
+      assert '://' not in port, port
+      port = int(port.rsplit(':', 1)[-1])
+    self.port = port
+    self.name = name
+    self.options = server_socket.Options(
+        **{**contextlib.context.serverkw, **kwargs})
+    self.errors = errors
+    self.packkw = dict(
+        compress=compress, compress_min=compress_min, version=version)
+    self.deltas = packlib.DeltaDecoder()
+    self.stripes = buffers.Stripes(
+        self.options.max_msg_size, connections=lambda: self.protocols)
+    self.methods = {}
+    self.protocols = set()
+    self.tasks = set()
+    self.server = None
+    self.closed = None
+    self.error = None
+    self.running = False
+
+  @property
+  def connections(self):
+    return tuple(self.protocols)
+
+  def bind(self, name, workfn, lazy=False):
+    assert not self.running
+    assert name not in self.methods, name
+    self.methods[name] = types.SimpleNamespace(workfn=workfn, lazy=lazy)
+
+  async def __aenter__(self):
+    await self.start(block=False)
+    return self
+
+  async def __aexit__(self, *e):
+    await self.close()
+
+  async def start(self, block=True):
+    assert not self.running
+    self.running = True
+    loop = asyncio.get_running_loop()
+    self.closed = loop.create_future()
+    factory = functools.partial(
+        Protocol, self.options.max_msg_size, self._recv,
+        self.protocols.add, self._disc)
+    if self.path:
+      utils.remove_socket(self.path)
+      self._log(f'Binding to unix://{self.path}')
+      self.server = await loop.create_unix_server(
+          factory, self.path, backlog=8192)
+    else:
+      if self.options.ipv6:
+        family, host = socket.AF_INET6, self.options.host or '::'
+      else:
+        family, host = socket.AF_INET, self.options.host or '0.0.0.0'
+      self._log(f'Binding to {host}:{self.port}')
+      self.server = await loop.create_server(
+          factory, host, self.port, family=family, reuse_address=True,
+          backlog=8192)
+    self._log('Listening')
+    if block:
+      await self.wait()
+
+  async def wait(self):
+    await asyncio.shield(self.closed)
+    if self.error:
+      raise self.error
+
+  async def close(self):
+    assert self.running
+    self.running = False
+    self.server.close()
+    [x.cancel() for x in self.tasks]
+    await asyncio.gather(*self.tasks, return_exceptions=True)
+    # Closing flushes responses that are still buffered by the transport.
+    [x.transport.close() for x in list(self.protocols)]
+    await self.server.wait_closed()
+    if self.path and os.path.exists(self.path):
+      os.unlink(self.path)
+    self.closed.done() or self.closed.set_result(None)
+
+  def _recv(self, protocol, data):
+    if not self.running:  # Do not accept further requests.
+      return
+    if len(data) < 8:
+      self._error(protocol, bytes(8), 1, 'Message too short')
+      return
+    if bytes(data[:8]) == buffers.STRIPE_MARKER:
+      # Large requests of clients with multiple streams arrive in stripes over
+      # several connections and are handled once complete.
+      self.stripes.expire()
+      try:
+        data = self.stripes.add(protocol, data)
+      except Exception:
+        self._error(protocol, bytes(8), 2, 'Could not decode message')
+        return
+      if data is None:
+        return
+    reqnum, data = bytes(data[:8]), data[8:]
+    try:
+      strlen = int.from_bytes(data[:8], 'little', signed=False)
+      name = bytes(data[8: 8 + strlen]).decode('utf-8')
+    except Exception:
+      self._error(protocol, reqnum, 2, 'Could not decode message')
+      return
+    if name not in self.methods:
+      self._error(protocol, reqnum, 3, f'Unknown method {name}')
+      return
+    method = self.methods[name]
+    try:
+      data = packlib.unpack(
+          data[8 + strlen:], lazy=method.lazy, delta=self.deltas)
+    except Exception:
+      self._error(protocol, reqnum, 2, 'Could not decode message')
+      return
+    task = asyncio.ensure_future(self._work(protocol, reqnum, method, data))
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+
+  async def _work(self, protocol, reqnum, method, data):
+    try:
+      result = method.workfn(*data)
+      if inspect.isawaitable(result):
+        result = await result
+      # The transport may hold on to the buffers after they were written, so
+      # the header is written into a new block for every response.
+      block = bytearray(16)
+      block[:8] = reqnum
+      block[8:16] = server.STATUS_OK
+      data = packlib.pack_into(block, result, 16, **self.packkw)
+    except Exception as e:
+      self._error(protocol, reqnum, 4, f'Error in server method: {e}')
+      return
+    if protocol.closing:
+      self._log('Dropping message to disconnected client')
+      return
+    protocol.send(*data)
+    await protocol.drain()
+
+  def _disc(self, protocol, exc):
+    self.protocols.discard(protocol)
+
+  def _error(self, protocol, reqnum, status, message):
+    status = status.to_bytes(8, 'little', signed=False)
+    data = message.encode('utf-8')
+    if not protocol.closing:
+      protocol.send(reqnum, status, data)
+    if self.errors and self.running:
+      # The error is delivered to the client before the connections close and
+      # then raised from start() or wait().
+      self.error = RuntimeError(message)
+      asyncio.ensure_future(self.close())
+
+  def _log(self, *args):
+    if not self.options.logging:
+      return
+    contextlib.context.print(
+        self.name, *args, color=self.options.logging_color)
@@ -1,14 +1,20 @@
+import os
+import socket
+import tempfile
 import threading
+import uuid
 
 import numpy as np
 import portal
 
+from . import buffers
 from . import client
 from . import packlib
 from . import process
 from . import server
 from . import server_socket
 from . import sharray
+from . import shmem_socket
 from . import thread
 from . import utils
 
@@ -17,20 +23,33 @@ class BatchServer:
 
   def __init__(
       self, port, name='Server', workers=1, errors=True,
-      process=True, shmem=False, **kwargs):
-    inner_port = utils.free_port()
+      process=True, shmem=False, compress=None,
+      compress_min=packlib.COMPRESS_MIN_SIZE, version=packlib.VERSION,
+      **kwargs):
+    assert compress is None or compress in packlib.CODECS, compress
+    # The batcher talks to the inner server on the same machine, so a Unix
+    # domain socket avoids the overhead of the TCP loopback where available.
+    if hasattr(socket, 'AF_UNIX'):
+      filename = f'portal-{uuid.uuid4().hex}.sock'
+      inner_port = 'unix://' + os.path.join(tempfile.gettempdir(), filename)
+    else:
+      inner_port = utils.free_port()
     assert port != inner_port, (port, inner_port)
     self.name = name
-    self.server = server.Server(inner_port, name, workers, errors, **kwargs)
+    # Options of the shared memory transport only apply to the outer socket.
+    innerkw = {k: v for k, v in kwargs.items() if k not in shmem_socket.KEYS}
+    self.server = server.Server(inner_port, name, workers, errors, **innerkw)
     if process:
       self.running = portal.context.mp.Event()
     else:
       self.running = threading.Event()
     self.process = process
     self.batsizes = {}
+    packkw = dict(
+        compress=compress, compress_min=compress_min, version=version)
     self.batargs = (
         self.running, port, inner_port, f'{name}Batcher',
-        self.batsizes, errors, shmem, kwargs)
+        self.batsizes, errors, shmem, packkw, kwargs)
     self.started = False
 
   def bind(self, name, workfn, donefn=None, batch=0, workers=0):
@@ -70,15 +89,28 @@ class BatchServer:
 
 def batcher(
     running, outer_port, inner_port, name, batsizes, errors, shmem,
-    kwargs):
+    packkw, kwargs):
 
   def maybe_recv(outer, inner, jobs, batches):
     if not running.is_set():  # Do not accept further requests.
       return
+    if held.full():  # Wait for the inner server to catch up.
+      return
     try:
       addr, data = outer.recv(timeout=0.0001)
     except TimeoutError:
       return
+    size = len(data)
+    if bytes(data[:8]) == buffers.STRIPE_MARKER:
+      # Large requests of clients with multiple streams arrive in stripes over
+      # several connections and are handled once complete.
+      try:
+        data = stripes.add(addr, data)
+      except Exception:
+        send_error(addr, bytes(8), 2, 'Could not decode message')
+        return
+      if data is None:
+        return
     reqnum = bytes(data[:8])
     data = data[8:]
     strlen = int.from_bytes(data[:8], 'little', signed=False)
@@ -87,11 +119,17 @@ def batcher(
     if name not in batsizes:
       send_error(addr, reqnum, 3, f'Unknown method {name}')
       return
-    data = packlib.unpack(data)
+    try:
+      data = packlib.unpack(data, delta=deltas)
+    except Exception:
+      send_error(addr, reqnum, 2, 'Could not decode message')
+      return
     batch_size = batsizes[name]
     if not batch_size:
       job = inner.call(name, *data)
       job.args = (False, addr, reqnum)
+      job.size = size
+      held.add(size)
       jobs.append(job)
       return
     leaves, structure = packlib.tree_flatten(data)
@@ -101,15 +139,15 @@ def batcher(
       return
     if name not in batches:
       if shmem:
-        buffers = [
+        arrays = [
             sharray.SharedArray((batch_size, *leaf.shape), leaf.dtype)
             for leaf in leaves]
       else:
-        buffers = [
+        arrays = [
             np.empty((batch_size, *leaf.shape), leaf.dtype)
             for leaf in leaves]
-      batches[name] = ([], [], structure, buffers)
-    addrs, reqnums, reference, buffers = batches[name]
+      batches[name] = ([], [], structure, arrays)
+    addrs, reqnums, reference, arrays = batches[name]
     if structure != reference:
       send_error(addr, reqnum, 6, (
           f'Argument structure {structure} does not match previous ' +
@@ -119,19 +157,23 @@ def batcher(
     index = len(addrs)
     addrs.append(addr)
     reqnums.append(reqnum)
-    for buffer, leaf in zip(buffers, leaves):
+    for buffer, leaf in zip(arrays, leaves):
       buffer[index] = leaf
+    held.add(size)
+    batchbytes[name] = batchbytes.get(name, 0) + size
     if len(addrs) == batch_size:
       del batches[name]
-      data = packlib.tree_unflatten(buffers, reference)
+      data = packlib.tree_unflatten(arrays, reference)
       job = inner.call(name, *data)
       job.args = (True, addrs, reqnums)
+      job.size = batchbytes.pop(name)
       jobs.append(job)
 
   def maybe_send(outer, inner, jobs):
     done, waiting = [], []
     [done.append(x) if x.done() else waiting.append(x) for x in jobs]
     for job in done:
+      held.release(job.size)
       batched, addr, reqnum = job.args
       try:
         result = job.result()
@@ -145,10 +187,11 @@ def batcher(
       status = int(0).to_bytes(8, 'little', signed=True)
       if batched:
         for i, (addr, reqnum) in enumerate(zip(addr, reqnum)):
-          data = packlib.pack(packlib.tree_map(lambda x: x[i], result))
+          data = packlib.pack(
+              packlib.tree_map(lambda x: x[i], result), offset=16, **packkw)
           outer.send(addr, reqnum, status, *data)
       else:
-        data = packlib.pack(result)
+        data = packlib.pack(result, offset=16, **packkw)
         outer.send(addr, reqnum, status, *data)
     return waiting
 
@@ -161,12 +204,28 @@ def batcher(
       raise RuntimeError(message)
 
   try:
-    outer = server_socket.ServerSocket(outer_port, f'{name}Server', **kwargs)
-    inner = client.Client(inner_port, f'{name}Client', **kwargs)
+    if str(outer_port).startswith('shm://'):
+      outer = shmem_socket.ShmemServerSocket(
+          outer_port, f'{name}Server', **kwargs)
+    else:
+      outer = server_socket.ServerSocket(
+          outer_port, f'{name}Server', **kwargs)
+    innerkw = {k: v for k, v in kwargs.items() if k not in shmem_socket.KEYS}
+    inner = client.Client(inner_port, f'{name}Client', **innerkw)
     batches = {}  # {method: ([addr], [reqnum], structure, [array])}
+    batchbytes = {}  # {method: bytes}
+    # Requests count against the receive budget until their response is
+    # sent, so that the outer socket stops reading while the inner server
+    # falls behind.
+    held = buffers.Budget(outer.options.max_recv_bytes)
+    deltas = packlib.DeltaDecoder()
+    stripes = buffers.Stripes(
+        outer.options.max_msg_size, getattr(outer, 'recvbudget', None),
+        lambda: outer.connections)
     jobs = []
     shutdown = False
     while running.is_set() or jobs:
+      stripes.expire()
       if running.is_set():
         maybe_recv(outer, inner, jobs, batches)
       elif not shutdown:
@@ -1,19 +1,57 @@
 import collections
+import contextlib
 import functools
 import itertools
+import os
+import struct
 import threading
 import time
 import weakref
 
+from . import buffers
 from . import client_socket
 from . import packlib
+from . import shmem_socket
+
+
+# Request number and method name length that precede the method name.
+PREFIX = struct.Struct('<QQ')
 
 
 class Client:
 
-  def __init__(self, addr, name='Client', maxinflight=16, **kwargs):
+  def __init__(
+      self, addr, name='Client', maxinflight=16, compress=None,
+      compress_min=packlib.COMPRESS_MIN_SIZE, delta=False, sendfile=False,
+      streams=1, version=packlib.VERSION, **kwargs):
     assert 1 <= maxinflight, maxinflight
+    assert 1 <= streams, streams
+    assert compress is None or compress in packlib.CODECS, compress
     self.maxinflight = maxinflight
+    # With delta encoding, large arrays are only sent in full the first time
+    # and afterwards as the chunks that changed. Packing and sending happen
+    # under a lock because the server applies the deltas in the order they
+    # arrive.
+    self.delta = delta and packlib.DeltaEncoder()
+    if delta:
+      # Chunks of large messages can be overtaken by smaller messages, which
+      # would apply deltas in the wrong order.
+      kwargs['chunk_size'] = 0
+    # Arrays mapped from files are sent with sendfile(), which the shared
+    # memory transport cannot use.
+    shmem = str(addr).startswith('shm://')
+    # Large requests are striped across multiple connections, which can arrive
+    # out of order and thus cannot carry deltas.
+    assert streams == 1 or not (delta or shmem), (
+        'Multiple streams require a TCP or Unix socket without delta encoding')
+    self.session = int.from_bytes(os.urandom(8), 'little')
+    self.packkw = dict(
+        compress=compress, compress_min=compress_min,
+        delta=self.delta or None, sendfile=sendfile and not shmem,
+        version=version)
+    self.sendlock = threading.Lock() if delta else contextlib.nullcontext()
+    self.arena = buffers.Arena()
+    self.names = {}
     self.reqnum = iter(itertools.count(0))
     self.futures = {}
     self.errors = collections.deque()
@@ -22,17 +60,27 @@ class Client:
     self.waitmean = [0, 0]
     self.cond = threading.Condition()
     self.lock = threading.Lock()
-    # Socket is created after the above attributes because the callbacks access
-    # some of the attributes.
-    self.socket = client_socket.ClientSocket(addr, name, start=False, **kwargs)
-    self.socket.callbacks_recv.append(self._recv)
-    self.socket.callbacks_disc.append(self._disc)
-    self.socket.callbacks_conn.append(self._conn)
-    self.socket.start()
+    # Sockets are created after the above attributes because the callbacks
+    # access some of the attributes.
+    self.sockets = []
+    for index in range(streams):
+      sockname = f'{name}{index}' if index else name
+      if shmem:
+        socket = shmem_socket.ShmemClientSocket(
+            addr, sockname, start=False, **kwargs)
+      else:
+        socket = client_socket.ClientSocket(
+            addr, sockname, start=False, **kwargs)
+      socket.callbacks_recv.append(functools.partial(self._recv, socket))
+      socket.callbacks_disc.append(functools.partial(self._disc, index))
+      socket.callbacks_conn.append(functools.partial(self._conn, index))
+      self.sockets.append(socket)
+    self.socket = self.sockets[0]
+    [x.start() for x in self.sockets]
 
   @property
   def connected(self):
-    return self.socket.connected
+    return all(x.connected for x in self.sockets)
 
   def __getattr__(self, name):
     if name.startswith('_'):
@@ -58,51 +106,84 @@ class Client:
     return stats
 
   def connect(self, timeout=None):
-    return self.socket.connect(timeout)
+    start = time.time()
+    for socket in self.sockets:
+      remaining = timeout and max(0, timeout - (time.time() - start))
+      if not socket.connect(remaining):
+        return False
+    return True
 
   def call(self, method, *data):
-    reqnum = next(self.reqnum).to_bytes(8, 'little', signed=False)
+    reqnum = next(self.reqnum)
     start = time.time()
     while len(self.futures) >= self.maxinflight:
       with self.cond: self.cond.wait(timeout=0.2)
-      try:
-        self.socket.require_connection(timeout=0)
-      except TimeoutError:
-        pass
+      # The request may be striped over any of the connections.
+      for socket in self.sockets:
+        try:
+          socket.require_connection(timeout=0)
+        except TimeoutError:
+          pass
     with self.lock:
       self.waitmean[1] += time.time() - start
       self.waitmean[0] += 1
       self.sendrate[0] += 1
     if self.errors:  # Raise errors of dropped futures.
       raise self.errors.popleft()
-    name = method.encode('utf-8')
-    strlen = len(name).to_bytes(8, 'little', signed=False)
-    sendargs = (reqnum, strlen, name, *packlib.pack(data))
-    rai = [False]
-    future = Future(rai)
-    future.sendargs = sendargs
-    self.futures[reqnum] = future
-    # Store future before sending request because the response may come fast
-    # and the response handler runs in the socket's background thread.
-    try:
-      self.socket.send(*sendargs)
-    except client_socket.Disconnected:
-      future = self.futures.pop(reqnum)
-      future.rai[0] = True
-      raise
+    name = self.names.get(method)
+    if name is None:
+      name = self.names[method] = method.encode('utf-8')
+    # The request prefix and message header are written into a block that is
+    # reused once the response has arrived and the sockets are done with all
+    # sends of the request, because the request may need to be sent again
+    # after a reconnect until then.
+    offset = PREFIX.size + len(name)
+    block = self.arena.acquire(offset)
+    PREFIX.pack_into(block, 0, reqnum, len(name))
+    block[PREFIX.size: offset] = name
+    with self.sendlock:
+      sendargs = packlib.pack_into(block, data, offset, **self.packkw)
+      # Large requests are split into stripes that are sent over the
+      # connections in parallel, keyed by the index of their connection.
+      count = min(len(self.sockets), sum(
+          len(x) for x in sendargs) // buffers.STRIPE_MIN_SIZE)
+      if count > 1:
+        stripes = buffers.stripes(sendargs, count, self.session, reqnum)
+        sendargs = dict(enumerate(stripes))
+      else:
+        sendargs = {0: sendargs}
+      rai = [False]
+      future = Future(rai)
+      future.sendargs = sendargs
+      future.block = block
+      future.holds = 1  # Released once the response arrives.
+      self.futures[reqnum] = future
+      # Store future before sending request because the response may come fast
+      # and the response handler runs in the socket's background thread.
+      try:
+        for index in sendargs:
+          self._send(future, index)
+      except client_socket.Disconnected:
+        future = self.futures.pop(reqnum)
+        future.rai[0] = True
+        self._unhold(future)
+        if self.delta:
+          self.delta.reset()
+        raise
     return future
 
   def close(self, timeout=None):
     for future in self.futures.values():
       self._seterr(future, client_socket.Disconnected)
     self.futures.clear()
-    self.socket.close(timeout)
+    [x.close(timeout) for x in self.sockets]
 
-  def _recv(self, data):
+  def _recv(self, socket, data):
     assert len(data) >= 16, 'Unexpectedly short response'
-    reqnum = bytes(data[:8])
-    status = int.from_bytes(data[8:16], 'little', signed=False)
+    reqnum, status = PREFIX.unpack(data[:16])
     future = self.futures.pop(reqnum, None)
+    if future:
+      self._unhold(future)
     if not future:
       existing = sorted(self.futures.keys())
       print(f'Unexpected request number: {reqnum}', existing)
@@ -115,24 +196,67 @@ class Client:
       self._seterr(future, RuntimeError(message))
       with self.cond: self.cond.notify_all()
     try:
-      self.socket.recv()
+      socket.recv()
     except AssertionError:
       pass  # Socket is already closed.
 
-  def _disc(self):
+  def _disc(self, index):
     if self.socket.options.autoconn:
+      # The response to a striped request arrives on the connection that
+      # delivered its last stripe, so all stripes are sent again.
       for future in list(self.futures.values()):
-        future.resend = True
+        if index in future.sendargs:
+          future.resend = True
     else:
-      for future in list(self.futures.values()):
-        self._seterr(future, client_socket.Disconnected)
-      self.futures.clear()
+      for reqnum, future in list(self.futures.items()):
+        if index in future.sendargs:
+          self._seterr(future, client_socket.Disconnected)
+          self.futures.pop(reqnum)
+          self._unhold(future)
 
-  def _conn(self):
+  def _conn(self, index):
+    if self.delta:
+      # The server may have restarted and lost the delta references, so new
+      # requests start from full arrays again.
+      with self.sendlock:
+        self.delta.reset()
     if self.socket.options.autoconn:
-      for future in list(self.futures.values()):
-        if getattr(future, 'resend', False):
-          self.socket.send(*future.sendargs)
+      for reqnum, future in list(self.futures.items()):
+        if not getattr(future, 'resend', False):
+          continue
+        if self.delta:
+          # Pending requests were encoded against references that the server
+          # may have lost, so they fail instead of being sent again.
+          self.futures.pop(reqnum)
+          self._unhold(future)
+          self._seterr(future, client_socket.Disconnected)
+          with self.cond: self.cond.notify_all()
+          continue
+        if not all(self.sockets[i].connected for i in future.sendargs):
+          continue  # Sent once the other connections are back.
+        future.resend = False
+        for i in future.sendargs:
+          self._send(future, i)
+
+  def _send(self, future, index):
+    # Each send holds the block of the request until the socket has written
+    # or dropped it, because the response to a striped request can arrive
+    # while stripes that were sent again are still queued.
+    with self.lock:
+      future.holds += 1
+    ondone = functools.partial(self._unhold, future)
+    try:
+      self.sockets[index].send(*future.sendargs[index], ondone=ondone)
+    except Exception:
+      ondone()
+      raise
+
+  def _unhold(self, future):
+    with self.lock:
+      future.holds -= 1
+      if future.holds:
+        return
+    self.arena.release(future.block)
 
   def _seterr(self, future, e):
     future.set_error(e)
@@ -1,4 +1,3 @@
-import collections
 import dataclasses
 import os
 import queue
@@ -11,6 +10,7 @@ import time
 from . import buffers
 from . import contextlib
 from . import thread
+from . import utils
 
 
 class Disconnected(Exception):
@@ -25,6 +25,14 @@ class Options:
   max_msg_size: int = 4 * 1024 ** 3
   max_recv_queue: int = 128
   max_send_queue: int = 128
+  max_recv_bytes: int = 0
+  max_send_bytes: int = 0
+  pool_max_bytes: int = 0
+  pool_prefault: bool = False
+  pool_hugepages: bool = False
+  zerocopy: bool = False
+  zerocopy_min: int = buffers.ZEROCOPY_MIN_SIZE
+  chunk_size: int = 0
   keepalive_after: float = 10
   keepalive_every: float = 10
   keepalive_fails: int = 10
@@ -37,12 +45,19 @@ class ClientSocket:
 
   def __init__(self, addr, name='Client', start=True, **kwargs):
     addr = str(addr)
-    assert '://' not in addr, addr
-    host, port = addr.rsplit(':', 1) if ':' in addr else ('', addr)
     self.name = name
     self.options = Options(**{**contextlib.context.clientkw, **kwargs})
-    host = host or ('::1' if self.options.ipv6 else '127.0.0.1')
-    self.addr = (host, port)
+    # Addresses of the form unix:///path/to/socket connect to a Unix domain
+    # socket of a server on the same machine.
+    self.path = None
+    if addr.startswith('unix://'):
+      self.path = addr[len('unix://'):]
+      self.addr = (self.path, '')
+    else:
+      assert '://' not in addr, addr
+      host, port = addr.rsplit(':', 1) if ':' in addr else ('', addr)
+      host = host or ('::1' if self.options.ipv6 else '127.0.0.1')
+      self.addr = (host, port)
 
     self.callbacks_recv = []
     self.callbacks_conn = []
@@ -50,9 +65,23 @@ class ClientSocket:
 
     self.isconn = threading.Event()
     self.wantconn = threading.Event()
-    self.sendq = collections.deque()
+    self.sendq = buffers.SendQueue()
     self.recvq = queue.Queue()
-    self.get_signal, self.set_signal = os.pipe()
+    self.notifier = utils.Notifier()
+    # Byte budgets for the messages in the receive queue and the messages that
+    # have not been written to the socket yet. Senders wait for the send
+    # budget and the socket is not read from while the receive budget is full.
+    self.sendbudget = buffers.Budget(self.options.max_send_bytes)
+    self.recvbudget = buffers.Budget(self.options.max_recv_bytes)
+    # When enabled, large messages are received into buffers that are reused
+    # once the application has released them.
+    self.pool = buffers.Pool(
+        maxbytes=self.options.pool_max_bytes,
+        prefault=self.options.pool_prefault,
+        hugepages=self.options.pool_hugepages)
+    self.paused = False
+    self.loopid = None
+    self.zerocopy = None
 
     self.running = True
     self.thread = thread.Thread(self._loop, name=f'{name}Loop')
@@ -70,17 +99,34 @@ class ClientSocket:
       self.wantconn.set()
     return self.isconn.wait(timeout)
 
-  def send(self, *data, timeout=None):
+  def send(self, *data, ondone=None, timeout=None, priority=0):
     assert self.running
     if len(self.sendq) > self.options.max_send_queue:
       raise RuntimeError('Too many outgoing messages enqueued')
     self.require_connection(timeout)
     maxsize = self.options.max_msg_size
-    self.sendq.append(buffers.SendBuffer(*data, maxsize=maxsize))
-    os.write(self.set_signal, bytes(1))
+    # Messages larger than the chunk size are sent in chunks that take turns
+    # with other messages of the same priority.
+    sendbuf = buffers.SendBuffer(
+        *data, maxsize=maxsize, ondone=ondone,
+        chunksize=self.options.chunk_size, priority=priority)
+    if threading.get_ident() == self.loopid:
+      # Callbacks run on the loop, which cannot wait for itself to send.
+      self.sendbudget.add(sendbuf.size)
+    else:
+      self.sendbudget.acquire(sendbuf.size, timeout)
+    self.sendq.append(sendbuf)
+    self.notifier.set()
 
   def recv(self, timeout=None):
     assert self.running
+    msg = self._dequeue(timeout)
+    self.recvbudget.release(len(msg))
+    if self.paused:
+      self.notifier.set()  # Resume reading from the socket.
+    return msg
+
+  def _dequeue(self, timeout):
     try:
       if timeout is not None and timeout <= 0.2:
         return self.recvq.get(block=(timeout != 0), timeout=timeout)
@@ -98,10 +144,10 @@ class ClientSocket:
 
   def close(self, timeout=None):
     self.running = False
+    self.notifier.set()  # Wake up the loop if it is waiting.
     self.thread.join(timeout)
     self.thread.kill()
-    os.close(self.get_signal)
-    os.close(self.set_signal)
+    self.notifier.close()
 
   def require_connection(self, timeout):
     if self.connected:
@@ -112,12 +158,15 @@ class ClientSocket:
       raise TimeoutError
 
   def _loop(self):
-    recvbuf = buffers.RecvBuffer(maxsize=self.options.max_msg_size)
+    recvbuf = buffers.RecvStream(
+        maxsize=self.options.max_msg_size, pool=self.pool)
     sock = None
     poll = select.poll()
-    poll.register(self.get_signal, select.POLLIN)
+    poll.register(self.notifier, select.POLLIN)
     isconn = False  # Local mirror of self.isconn without the lock.
-    writing = False
+    blocked = False  # Waiting for the socket to become writable.
+    events = select.POLLIN
+    self.loopid = threading.get_ident()
 
     while self.running or (self.sendq and isconn):
 
@@ -127,7 +176,12 @@ class ClientSocket:
         sock = self._connect()
         if not sock:
           break
-        poll.register(sock, select.POLLIN)
+        events = select.POLLIN
+        poll.register(sock, events)
+        # Large buffers are sent with MSG_ZEROCOPY where the socket supports
+        # it.
+        if self.options.zerocopy:
+          self.zerocopy = buffers.ZeroCopy(sock, self.options.zerocopy_min)
         self.isconn.set()
         isconn = True
         if not self.options.autoconn:
@@ -136,33 +190,58 @@ class ClientSocket:
 
       try:
 
-        if not writing:
-          fds = [fd for fd, _ in poll.poll(0.2)]
-          if self.get_signal in fds:
-            writing = True
-            os.read(self.get_signal, 1)
-
-        try:
-          recvbuf.recv(sock)
-          if recvbuf.done():
-            if self.recvq.qsize() > self.options.max_recv_queue:
-              raise RuntimeError('Too many incoming messages enqueued')
-            msg = recvbuf.result()
-            self.recvq.put(msg)
-            [x(msg) for x in self.callbacks_recv]
-            recvbuf = buffers.RecvBuffer(maxsize=self.options.max_msg_size)
-        except BlockingIOError:
-          pass
-
-        if self.sendq:
+        # Only wait for the socket to become readable while there is space
+        # in the receive budget and for it to become writable when its buffer
+        # was full.
+        self.paused = self.recvbudget.full()
+        wanted = 0 if self.paused else select.POLLIN
+        wanted |= select.POLLOUT if blocked else 0
+        if wanted != events:
+          poll.modify(sock, wanted)
+          events = wanted
+
+        # Only block when there is nothing to send right away. The timeout
+        # of poll() is in milliseconds.
+        timeout = 0 if self.sendq and not blocked else 200
+        events = dict(poll.poll(timeout))
+        if self.notifier.fileno() in events:
+          self.notifier.clear()
+        mask = events.get(sock.fileno(), 0)
+
+        # Completions of zero-copy sends arrive on the error queue. Once it
+        # is drained, an error flag without pending socket error only stood
+        # for the completions and the socket is not read from.
+        if self.zerocopy and mask & select.POLLERR:
+          self.zerocopy.reap(sock)
+          if not mask & (select.POLLIN | select.POLLHUP):
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+              raise OSError(error, os.strerror(error))
+            mask &= ~select.POLLERR
+
+        if mask & (select.POLLIN | select.POLLHUP | select.POLLERR):
           try:
-            self.sendq[0].send(sock)
-            if self.sendq[0].done():
-              self.sendq.popleft()
-              if not self.sendq:
-                writing = False
+            recvbuf.recv(sock)
+            for msg in recvbuf.results():
+              if self.recvq.qsize() > self.options.max_recv_queue:
+                raise RuntimeError('Too many incoming messages enqueued')
+              self.recvbudget.add(len(msg))
+              self.recvq.put(msg)
+              [x(msg) for x in self.callbacks_recv]
           except BlockingIOError:
             pass
+
+        if mask & select.POLLOUT:
+          blocked = False
+
+        if self.sendq and not blocked:
+          try:
+            self.sendbudget.release(
+                buffers.sendmany(sock, self.sendq, zerocopy=self.zerocopy))
+          except BlockingIOError:
+            # The socket buffer is full, so we wait until it becomes
+            # writable instead of trying again in every iteration.
+            blocked = True
           except ConnectionResetError:
             # The server is gone but we may have buffered messages left to
             # read, so we keep the socket open until recv() fails.
@@ -174,6 +253,7 @@ class ClientSocket:
         self._log(f'Connection to server lost ({detail})')
         self.isconn.clear()
         isconn = False
+        blocked = False
         poll.unregister(sock)
         sock.close()
         # Clear message queue on disconnect. There is no meaningful concept of
@@ -181,8 +261,16 @@ class ClientSocket:
         # server could receive the message but then go down immediately after,
         # without doing anything meaningful with the message. Resending can be
         # done based on response messages at a higher level.
-        self.sendq.clear()
-        recvbuf = buffers.RecvBuffer(maxsize=self.options.max_msg_size)
+        # The callbacks of dropped messages run as well, because the socket
+        # no longer uses their buffers.
+        size = 0
+        while self.sendq:
+          sendbuf = self.sendq.popleft()
+          size += sendbuf.unsent()
+          sendbuf.ondone and sendbuf.ondone()
+        self.sendbudget.release(size)
+        recvbuf = buffers.RecvStream(
+            maxsize=self.options.max_msg_size, pool=self.pool)
         [x() for x in self.callbacks_disc]
         continue
 
@@ -190,16 +278,22 @@ class ClientSocket:
       sock.close()
 
   def _connect(self):
-    self._log(f'Connecting to {self.addr[0]}:{self.addr[1]}')
+    if self.path:
+      self._log(f'Connecting to unix://{self.path}')
+    else:
+      self._log(f'Connecting to {self.addr[0]}:{self.addr[1]}')
     once = True
     while self.running:
-      # We need to resolve the address regularly.
-      host, port = self.addr
-      if contextlib.context.resolver:
-        host, port = contextlib.context.resolver((host, port))
-        assert isinstance(host, str), (host, port)
-      port = int(port)
-      addr = (host, port, 0, 0) if self.options.ipv6 else (host, port)
+      if self.path:
+        addr = self.path
+      else:
+        # We need to resolve the address regularly.
+        host, port = self.addr
+        if contextlib.context.resolver:
+          host, port = contextlib.context.resolver((host, port))
+          assert isinstance(host, str), (host, port)
+        port = int(port)
+        addr = (host, port, 0, 0) if self.options.ipv6 else (host, port)
       sock = self._create()
       error = None
       try:
@@ -214,6 +308,8 @@ class ClientSocket:
         error = e
       except socket.gaierror as e:
         error = e
+      except FileNotFoundError as e:
+        error = e  # The server has not created its Unix socket yet.
       if once:
         self._log(f'Still trying to connect... ({error})')
         once = False
@@ -222,6 +318,12 @@ class ClientSocket:
     return None
 
   def _create(self):
+    if self.path:
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      # The default buffer of Unix sockets is small, so that large messages
+      # would need many more system calls than over the TCP loopback.
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 ** 2)
+      return sock
     if self.options.ipv6:
       sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
       sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
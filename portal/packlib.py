@@ -1,77 +1,752 @@
+import bz2
+import collections
+import collections.abc
+import concurrent.futures
+import functools
+import lzma
+import math
+import mmap
+import os
 import struct
+import types
+import zlib
 
 import msgpack
 import numpy as np
 
+from . import buffers as bufferlib
 from . import sharray
 
+try:
+  import lz4.frame
+except ImportError:
+  lz4 = None
 
-def pack(data):
-  leaves, treedef = tree_flatten(data)
-  specs, buffers = [], []
-  for value in leaves:
-    if value is None:
-      specs.append(['none'])
-      buffers.append(b'\x00')
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+
+# Number of distinct message structures for which the encoded header and the
+# decoded flat structure are cached. Applications usually send only a handful
+# of different argument structures, so the caches almost always hit.
+SCHEMA_CACHE_SIZE = 1024
+
+# Messages start with a 64-bit word that holds the format version in the
+# highest byte and the number of entries in the lower bytes. Version 0 is the
+# original unaligned format, in which the word only stores the number of
+# entries. Version 1 stores explicit offsets so that leaves can be aligned.
+# Version 2 adds an entry that holds the values of small leaves inline.
+# Packing with version=0 writes the original format, so that peers that do not
+# know the newer versions can read the messages during a rollout.
+VERSION = 2
+
+# Array and bytes leaves are padded to start at a multiple of this many bytes
+# from the beginning of the receive buffer, matching the cache line size and
+# the widest SIMD registers.
+ALIGN = 64
+
+# Python scalars, None, and strings up to this length are not sent as separate
+# buffers but encoded together into a single msgpack entry of the message.
+INLINE_STR_SIZE = 256
+
+# Lists of at least this many arrays of the same dtype and trailing shape are
+# sent as a single ragged leaf, consisting of the concatenated data and an
+# offsets array, unless the arrays are larger than the maximum item size on
+# average, in which case the copy for concatenating them is not worth it.
+RAGGED_MIN_LENGTH = 16
+RAGGED_MAX_ITEM_SIZE = 64 * 1024
+
+# Non-contiguous arrays are sent as separate contiguous segments when the
+# segments are at least this large, and copied into a contiguous buffer when
+# they are smaller, because writing many small segments is slower than a copy.
+STRIDED_MIN_SEGMENT = 16 * 1024
+
+# Compression codecs as pairs of compress and decompress functions. Array and
+# bytes leaves of at least the minimum size are split into chunks that are
+# compressed in parallel, and sent uncompressed if that does not save space.
+CODECS = {
+    'zlib': (lambda x: zlib.compress(x, 1), zlib.decompress),
+    'lzma': (lambda x: lzma.compress(x, preset=0), lzma.decompress),
+    'bz2': (lambda x: bz2.compress(x, 1), bz2.decompress),
+}
+if lz4:
+  CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+if zstandard:
+  CODECS['zstd'] = (
+      lambda x: zstandard.ZstdCompressor(level=1).compress(x),
+      lambda x: zstandard.ZstdDecompressor().decompress(x))
+COMPRESS_MIN_SIZE = 64 * 1024
+COMPRESS_CHUNK_SIZE = 4 * 1024 ** 2
+
+# Arrays of at least the minimum size are delta encoded when packing with a
+# DeltaEncoder, by sending only the chunks that changed since the array at the
+# same position in the same structure was last sent. The decoder keeps the
+# reference arrays of this many sessions, i.e. encoders that it received from.
+DELTA_MIN_SIZE = 64 * 1024
+DELTA_CHUNK_SIZE = 4 * 1024
+DELTA_MAX_SESSIONS = 64
+
+# Contiguous arrays of at least this size that are views of a file mapped with
+# np.memmap, such as arrays from np.load(mmap_mode='r'), are sent from the file
+# with sendfile() when packing with sendfile=True. They arrive as normal
+# arrays. Smaller arrays are written from memory together with the rest of the
+# message, which needs fewer system calls.
+SENDFILE_MIN_SIZE = 64 * 1024
+
+
+def pack(
+    data, align=ALIGN, offset=0, inline=True,
+    compress=None, compress_min=COMPRESS_MIN_SIZE, delta=None, sendfile=False,
+    version=VERSION):
+  # The offset is the position at which the packed message will start inside
+  # the received frame, so that the padding can be computed with respect to
+  # the beginning of the receive buffer rather than the message. With
+  # sendfile=True, the returned buffers can include FileRange objects, which
+  # only the socket transports can send.
+  return _pack(
+      None, 0, offset, data, align, inline, compress, compress_min, delta,
+      sendfile, version)
+
+
+def pack_into(
+    block, data, start=0, align=ALIGN, inline=True,
+    compress=None, compress_min=COMPRESS_MIN_SIZE, delta=None, sendfile=False,
+    version=VERSION):
+  # Writes the message header into the block starting at the given position,
+  # so that reusing blocks avoids allocating the header for every message.
+  # The first returned buffer is a view of the block up to the end of the
+  # header, including any prefix that the caller wrote before the start. If
+  # the header does not fit, a new block is allocated and the prefix copied.
+  return _pack(
+      block, start, start, data, align, inline, compress, compress_min, delta,
+      sendfile, version)
+
+
+def _pack(
+    block, start, offset, data, align, inline, compress, compress_min, delta,
+    sendfile, version):
+  assert 1 <= align, align
+  assert compress is None or compress in CODECS, (compress, tuple(CODECS))
+  assert version in (0, VERSION), version
+  if version == 0:
+    # The original format only knows plain leaves that are sent as they are.
+    assert not compress and not delta, (
+        'Version 0 supports neither compression nor delta encoding')
+    inline = False
+  leaves, structure = tree_flatten(data, isleaf=_ragged if version else None)
+  # The buffers are stored together with whether they should be aligned.
+  specs, buffers, values = [], [], []
+  for index, value in enumerate(leaves):
+    if inline and _inlinable(value):
+      specs.append(('inline',))
+      values.append(value)
+    elif value is None:
+      specs.append(('none',))
+      buffers.append((b'\x00', False))
     elif isinstance(value, str):
-      specs.append(['utf8'])
-      buffers.append(value.encode('utf-8'))
+      specs.append(('utf8',))
+      buffers.append((value.encode('utf-8'), False))
     elif isinstance(value, (bytes, bytearray, memoryview)):
       if isinstance(value, memoryview):
         value = value.cast('c')
         assert value.c_contiguous
-      specs.append(['bytes'])
-      buffers.append(value)
+      specs.append(('bytes',))
+      buffers.append((value, True))
+    elif delta and delta.accepts(value):
+      spec, content, indices, meta = delta.encode((structure, index), value)
+      specs.append(spec)
+      values.append(meta)
+      buffers.append((content, True))
+      buffers.append((indices, True))
     elif isinstance(value, (np.ndarray, np.generic, int, float)):
       value = np.asarray(value)
       if value.dtype == object:
         raise TypeError(data)
-      assert value.data.c_contiguous, (
-          "Array is not contiguous in memory. Use " +
-          "np.asarray(arr, order='C') before passing the data into pack().")
-      specs.append(['array', value.shape, value.dtype.str])
-      buffers.append(value.data.cast('c'))
+      filerange = sendfile and _file_range(value)
+      if filerange:
+        spec, buffer = ('array', value.shape, value.dtype.str), filerange
+      elif version == 0:
+        value = value if value.flags.c_contiguous else value.copy(order='C')
+        spec, buffer = ('array', value.shape, value.dtype.str), _bytes(value)
+      else:
+        spec, buffer = _pack_array(value)
+      specs.append(spec)
+      buffers.append((buffer, True))
+    elif isinstance(value, list):
+      offsets = np.cumsum([0] + [len(x) for x in value], dtype='<i8')
+      content = np.concatenate(value)
+      specs.append(('ragged', content.dtype.str, content.shape[1:]))
+      buffers.append((content.reshape(-1).data.cast('c'), True))
+      buffers.append((offsets.data.cast('c'), True))
     elif isinstance(value, sharray.SharedArray):
-      specs.append(['sharray', *value.__getstate__()])
-      buffers.append(b'\x00')
+      specs.append(('sharray', *value.__getstate__()))
+      buffers.append((b'\x00', False))
     else:
       raise NotImplementedError(type(value))
-  buffers = [msgpack.packb(treedef), msgpack.packb(specs), *buffers]
-  length = len(buffers).to_bytes(8, 'little', signed=False)
-  sizes = struct.pack('<' + ('Q' * len(buffers)), *[len(x) for x in buffers])
-  buffers = [length, sizes, *buffers]
-  return buffers
-
-
-def unpack(buffer):
-  length = int.from_bytes(buffer[:8], 'little', signed=False)
-  buffer = buffer[8:]
-  sizes = struct.unpack('<' + ('Q' * length), buffer[:8 * length])
-  buffer = buffer[8 * length:]
-  limits = np.cumsum(sizes)
-  buffers = [buffer[i: j] for i, j in zip([0, *limits[:-1]], limits)]
-  treedef, specs, *buffers = buffers
-  treedef = msgpack.unpackb(treedef)
+  if compress:
+    _compress_leaves(specs, buffers, compress, compress_min)
+  treedef, specbuf = _encode_schema(structure, tuple(specs))
+  if version == 0:
+    return _pack_legacy(block, start, treedef, specbuf, buffers)
+  values = msgpack.packb(values) if values else _EMPTY_LIST
+  # Layout: head, table of (start, size) pairs, treedef, specs, inline values,
+  # leaves. The header up to and including the inline values is written into
+  # the block. Empty buffers are left out because their position does not
+  # matter.
+  count = 3 + len(buffers)
+  pos = 8 + 16 * count
+  size = pos + len(treedef) + len(specbuf) + len(values)
+  block = _reserve(block, start, size)
+  _uint64s(1).pack_into(block, start, (VERSION << 56) | count)
+  table = []
+  for buffer in (treedef, specbuf, values):
+    block[start + pos: start + pos + len(buffer)] = buffer
+    table += (pos, len(buffer))
+    pos += len(buffer)
+  parts = [memoryview(block)[:start + size]]
+  for buffer, aligned in buffers:
+    if aligned and (offset + pos) % align:
+      padding = align - (offset + pos) % align
+      parts.append(_zeros(padding))
+      pos += padding
+    # A leaf buffer can consist of multiple parts that are sent back to back.
+    size = _size(buffer)
+    if isinstance(buffer, tuple):
+      parts += [x for x in buffer if len(x)]
+    elif size:
+      parts.append(buffer)
+    table += (pos, size)
+    pos += size
+  _uint64s(2 * count).pack_into(block, start + 8, *table)
+  return parts
+
+
+def _pack_legacy(block, start, treedef, specbuf, buffers):
+  # Layout: number of entries, table of sizes, treedef, specs, leaves, all
+  # back to back without padding.
+  count = 2 + len(buffers)
+  sizes = [len(treedef), len(specbuf), *(_size(x) for x, _ in buffers)]
+  size = 8 + 8 * count + len(treedef) + len(specbuf)
+  block = _reserve(block, start, size)
+  _uint64s(1 + count).pack_into(block, start, count, *sizes)
+  pos = start + 8 + 8 * count
+  block[pos: pos + len(treedef)] = treedef
+  block[pos + len(treedef): start + size] = specbuf
+  parts = [memoryview(block)[:start + size]]
+  for buffer, _ in buffers:
+    if isinstance(buffer, tuple):
+      parts += [x for x in buffer if len(x)]
+    elif _size(buffer):
+      parts.append(buffer)
+  return parts
+
+
+def _reserve(block, start, size):
+  # Returns the block if the header fits, else a new block with the prefix.
+  if block is None or len(block) < start + size:
+    prefix = block[:start] if block is not None else b''
+    block = bytearray(start + size)
+    block[:start] = prefix
+  return block
+
+
+def unpack(buffer, lazy=False, delta=None):
+  # With lazy=True, containers are returned as read-only LazyDict and LazyList
+  # proxies that decode each leaf only when it is first accessed. Calling
+  # materialize() on a proxy returns the plain Python objects. Messages that
+  # contain delta encoded arrays require the DeltaDecoder of the connection.
+  head = int.from_bytes(buffer[:8], 'little', signed=False)
+  version, count = head >> 56, head & ((1 << 56) - 1)
+  if version == 0:
+    buffer = buffer[8:]
+    sizes = _uint64s(count).unpack(buffer[:8 * count])
+    buffer = buffer[8 * count:]
+    limits = np.cumsum(sizes)
+    buffers = [buffer[i: j] for i, j in zip([0, *limits[:-1]], limits)]
+  elif version in (1, 2):
+    table = _uint64s(2 * count).unpack(buffer[8: 8 + 16 * count])
+    buffers = [
+        buffer[start: start + size]
+        for start, size in zip(table[::2], table[1::2])]
+  else:
+    raise ValueError(f'Unsupported message format version {version}')
+  if version >= 2:
+    treedef, specs, values, *buffers = buffers
+    values = msgpack.unpackb(values)
+  else:
+    treedef, specs, *buffers = buffers
+    values = []
+  treedef, specs = bytes(treedef), bytes(specs)
+  if lazy:
+    tree = _LazyTree(_lazy_plan(treedef, specs), buffers, values, delta)
+    # Delta encoded leaves are patched right away, because they need to be
+    # applied to the references in the order in which messages arrive.
+    for pos in tree.plan.deltas:
+      tree.node(pos)
+    return tree.node(0)
+  specs, structure = _decode_schema(treedef, specs)
+  if not buffers and len(values) == len(specs):
+    return tree_unflatten([_inline_leaf(x) for x in values], structure)
+  values, buffers = iter(values), iter(buffers)
+  leaves = [_decode_leaf(spec, buffers, values, delta) for spec in specs]
+  data = tree_unflatten(leaves, structure)
+  return data
+
+
+def _decode_leaf(spec, buffers, values, delta=None):
+  # Decodes a leaf, taking its buffers and inline value from the iterators.
+  if spec[0] == 'inline':
+    return _inline_leaf(next(values))
+  if spec[0] == 'delta':
+    if delta is None:
+      raise ValueError('Delta encoded message requires a DeltaDecoder')
+    return delta.decode(spec, next(buffers), next(buffers), next(values))
+  if spec[0] == 'ragged':
+    dtype, shape = spec[1:]
+    content, offsets = next(buffers), next(buffers)
+    offsets = np.frombuffer(offsets, '<i8').tolist()
+    content = np.frombuffer(content, dtype).reshape((offsets[-1], *shape))
+    return [content[i: j] for i, j in zip(offsets[:-1], offsets[1:])]
+  buffer = next(buffers)
+  if spec[0] == 'compressed':
+    _, codec, spec = spec
+    buffer = _decompress(codec, buffer)
+  if spec[0] == 'none':
+    assert buffer == b'\x00'
+    return None
+  elif spec[0] == 'utf8':
+    return bytes(buffer).decode('utf-8')
+  elif spec[0] == 'bytes':
+    return buffer
+  elif spec[0] == 'array':
+    shape, dtype, *axes = spec[1:]
+    value = np.frombuffer(buffer, dtype).reshape(shape)
+    return value.transpose(axes[0]) if axes else value
+  elif spec[0] == 'sharray':
+    assert buffer == b'\x00'
+    return sharray.SharedArray(*spec[1:])
+  else:
+    raise NotImplementedError(spec)
+
+
+class DeltaEncoder:
+
+  # Keeps a copy of the last sent version of each large array, so that the
+  # next message only needs to contain the chunks that differ from it. The
+  # messages need to be sent in the order in which they were packed.
+
+  def __init__(self, minsize=DELTA_MIN_SIZE, chunksize=DELTA_CHUNK_SIZE):
+    assert chunksize % 8 == 0, chunksize
+    self.minsize = minsize
+    self.chunksize = chunksize
+    self.reset()
+
+  def reset(self):
+    # A new session makes the following messages independent of all previous
+    # ones, which is needed when the receiver may have lost its references.
+    self.session = int.from_bytes(os.urandom(7), 'little')
+    self.keys = {}
+    self.refs = {}
+
+  def accepts(self, value):
+    return (
+        isinstance(value, np.ndarray) and value.dtype != object and
+        value.nbytes >= self.minsize)
+
+  def encode(self, key, value):
+    key = self.keys.setdefault(key, len(self.keys))
+    spec = ('delta', value.shape, value.dtype.str, self.chunksize)
+    new = np.ascontiguousarray(value).reshape(-1).view(np.uint8)
+    version, ref = self.refs.get(key, (-1, None))
+    if ref is None or ref.size != new.size:
+      self.refs[key] = (version + 1, new.copy())
+      return spec, new.data, b'', [self.session, key, None, version + 1]
+    size = self.chunksize
+    full = new.size // size
+    count = -(-new.size // size)
+    changed = np.empty(count, bool)
+    changed[:full] = (
+        ref[:full * size].view(np.uint64).reshape(full, -1) !=
+        new[:full * size].view(np.uint64).reshape(full, -1)).any(1)
+    if full < count:
+      changed[full] = (ref[full * size:] != new[full * size:]).any()
+    indices = np.flatnonzero(changed).astype('<i8')
+    if len(indices) == count:
+      ref[:] = new
+      self.refs[key] = (version + 1, ref)
+      return spec, new.data, b'', [self.session, key, None, version + 1]
+    head = indices[:np.searchsorted(indices, full)]
+    parts = [new[:full * size].reshape(full, size)[head].reshape(-1)]
+    ref[:full * size].reshape(full, size)[head] = parts[0].reshape(-1, size)
+    if len(head) < len(indices):
+      parts.append(new[full * size:])
+      ref[full * size:] = new[full * size:]
+    content = np.concatenate(parts) if len(parts) > 1 else parts[0]
+    self.refs[key] = (version + 1, ref)
+    meta = [self.session, key, version, version + 1]
+    return spec, content.data, indices.data.cast('c'), meta
+
+
+class DeltaDecoder:
+
+  # Keeps the reference arrays of the sessions it received from and patches
+  # them with the changed chunks of delta encoded messages. Messages need to
+  # be decoded in the order in which they were packed.
+
+  def __init__(self, maxsessions=DELTA_MAX_SESSIONS):
+    self.maxsessions = maxsessions
+    self.sessions = collections.OrderedDict()
+
+  def decode(self, spec, content, indices, meta):
+    _, shape, dtype, size = spec
+    session, key, base, version = meta
+    refs = self.sessions.pop(session, None)
+    refs = {} if refs is None else refs
+    self.sessions[session] = refs
+    while len(self.sessions) > self.maxsessions:
+      self.sessions.popitem(last=False)
+    current, ref = refs.get(key, (None, None))
+    if current == version:
+      pass  # Message was sent again after a reconnect and is already applied.
+    elif base is None:
+      refs[key] = (version, np.frombuffer(content, np.uint8).copy())
+      return np.frombuffer(content, dtype).reshape(shape)
+    elif current != base:
+      raise ValueError(
+          f'Delta encoded array {key} expects reference version {base} ' +
+          f'but the decoder has version {current}')
+    else:
+      content = np.frombuffer(content, np.uint8)
+      indices = np.frombuffer(indices, '<i8')
+      full = ref.size // size
+      head = indices[:np.searchsorted(indices, full)]
+      ref[:full * size].reshape(full, size)[head] = (
+          content[:len(head) * size].reshape(-1, size))
+      if len(head) < len(indices):
+        ref[full * size:] = content[len(head) * size:]
+    refs[key] = (version, ref)
+    # The reference is patched by later messages, so the result is a copy.
+    return ref.copy().view(dtype).reshape(shape)
+
+
+class LazyDict(collections.abc.Mapping):
+
+  def __init__(self, tree, pos):
+    self._tree = tree
+    self._pos = pos
+    self._keys = tree.plan.structure[pos][1]
+    self._children = None
+
+  def __getitem__(self, key):
+    if self._children is None:
+      self._children = dict(zip(self._keys, self._tree.children(self._pos)))
+    return self._tree.node(self._children[key])
+
+  def __iter__(self):
+    return iter(self._keys)
+
+  def __len__(self):
+    return len(self._keys)
+
+  def __repr__(self):
+    return f'LazyDict(keys={list(self._keys)})'
+
+  def materialize(self):
+    return self._tree.materialize(self._pos)
+
+
+class LazyList(collections.abc.Sequence):
+
+  def __init__(self, tree, pos):
+    self._tree = tree
+    self._pos = pos
+    self._length = tree.plan.structure[pos][1]
+    self._children = None
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in range(*index.indices(self._length))]
+    if self._children is None:
+      self._children = self._tree.children(self._pos)
+    return self._tree.node(self._children[index])
+
+  def __len__(self):
+    return self._length
+
+  def __repr__(self):
+    return f'LazyList(length={self._length})'
+
+  def materialize(self):
+    return self._tree.materialize(self._pos)
+
+
+class _LazyTree:
+
+  def __init__(self, plan, buffers, values, delta=None):
+    self.plan = plan
+    self.buffers = buffers
+    self.values = values
+    self.delta = delta
+    self.nodes = {}
+
+  def node(self, pos):
+    try:
+      return self.nodes[pos]
+    except KeyError:
+      pass
+    node = self.plan.structure[pos]
+    if node is None:
+      index = self.plan.leaves[pos]
+      spec = self.plan.specs[index]
+      buf, val = self.plan.offsets[index]
+      value = _decode_leaf(
+          spec, iter(self.buffers[buf: buf + 2]),
+          iter(self.values[val: val + 1]), self.delta)
+    elif node[0] is dict:
+      value = LazyDict(self, pos)
+    else:
+      value = LazyList(self, pos)
+    self.nodes[pos] = value
+    return value
+
+  def children(self, pos):
+    arg = self.plan.structure[pos][1]
+    spans = self.plan.spans
+    children, child = [], pos + 1
+    for _ in range(arg if isinstance(arg, int) else len(arg)):
+      children.append(child)
+      child += spans[child]
+    return children
+
+  def materialize(self, pos):
+    stop = pos + self.plan.spans[pos]
+    structure = self.plan.structure[pos: stop]
+    leaves = [
+        self.node(i) for i in range(pos, stop)
+        if self.plan.structure[i] is None]
+    return tree_unflatten(leaves, structure)
+
+
+def _inlinable(value):
+  if value is None or type(value) in (bool, float):
+    return True
+  if type(value) is int:
+    return -2 ** 63 <= value < 2 ** 64
+  if type(value) is str:
+    return len(value) <= INLINE_STR_SIZE
+  return False
+
+
+def _inline_leaf(value):
+  # Numbers and booleans are unpacked as 0-d arrays, the same as when they are
+  # sent as array leaves.
+  if value is None or type(value) is str:
+    return value
+  return np.asarray(value)
+
+
+_EMPTY_LIST = msgpack.packb([])
+
+
+@functools.lru_cache(maxsize=None)
+def _zeros(size):
+  return bytes(size)
+
+
+def _pack_array(value):
+  # Returns the spec and the buffer of an array without copying its content
+  # whenever possible. The buffer is a tuple of parts for arrays that are sent
+  # as multiple contiguous segments.
+  if value.flags.c_contiguous:
+    return ('array', value.shape, value.dtype.str), _bytes(value)
+  # Arrays with permuted axes, such as transposed views, are sent in memory
+  # order together with the axes to restore the original view.
+  perm = sorted(range(value.ndim), key=lambda i: -value.strides[i])
+  transposed = value.transpose(perm)
+  if transposed.flags.c_contiguous:
+    axes = tuple(sorted(range(value.ndim), key=lambda i: perm[i]))
+    spec = ('array', transposed.shape, value.dtype.str, axes)
+    return spec, _bytes(transposed)
+  # Sliced arrays whose trailing dimensions form large enough contiguous
+  # blocks are sent as a list of segments. Otherwise, they are copied.
+  inner = value.ndim
+  while inner > 0 and value[(0,) * (inner - 1)].flags.c_contiguous:
+    inner -= 1
+  segment = math.prod(value.shape[inner:]) * value.itemsize
+  if inner < value.ndim and segment >= STRIDED_MIN_SEGMENT:
+    parts = tuple(_bytes(value[i]) for i in np.ndindex(value.shape[:inner]))
+    return ('array', value.shape, value.dtype.str), parts
+  value = np.ascontiguousarray(value)
+  return ('array', value.shape, value.dtype.str), _bytes(value)
+
+
+def _file_range(value):
+  # Returns the range of the file that a contiguous array views, if it was
+  # mapped from a file with np.memmap. Slices of a memmap keep the offset of
+  # the original map, so the position is computed from the data pointers.
+  if value.nbytes < SENDFILE_MIN_SIZE or not value.flags.c_contiguous:
+    return None
+  root = value
+  while isinstance(root.base, np.ndarray):
+    root = root.base
+  if not isinstance(root, np.memmap) or not isinstance(root.base, mmap.mmap):
+    return None
+  # Copy-on-write maps can differ from the file content.
+  if root.filename is None or root.mode == 'c':
+    return None
+  offset = root.offset + value.ctypes.data - root.ctypes.data
+  return bufferlib.FileRange(root.filename, offset, value.nbytes)
+
+
+def _bytes(value):
+  return value.reshape(-1).data.cast('c')
+
+
+def _size(buffer):
+  if isinstance(buffer, tuple):
+    return sum(len(x) for x in buffer)
+  return len(buffer)
+
+
+def _compress_leaves(specs, buffers, codec, minsize):
+  # Compresses all large enough array and bytes leaves in place. The chunks of
+  # all leaves are compressed in parallel if there is more than one.
+  compress = CODECS[codec][0]
+  candidates = []
+  index = 0
+  for i, spec in enumerate(specs):
+    if spec[0] == 'inline':
+      continue
+    buffer = buffers[index][0]
+    if isinstance(buffer, bufferlib.FileRange):
+      buffer = buffer.memory()
+    if isinstance(buffer, tuple):
+      buffer = b''.join(buffer) if _size(buffer) >= minsize else b''
+    if spec[0] in ('array', 'bytes') and len(buffer) >= minsize:
+      buffer = memoryview(buffer).cast('c')
+      chunks = [
+          buffer[j: j + COMPRESS_CHUNK_SIZE]
+          for j in range(0, len(buffer), COMPRESS_CHUNK_SIZE)]
+      candidates.append((i, index, len(buffer), chunks))
+    index += 2 if spec[0] in ('ragged', 'delta') else 1
+  flat = [x for *_, chunks in candidates for x in chunks]
+  flat = iter(_parallel(compress, [(x,) for x in flat]))
+  for i, index, size, chunks in candidates:
+    chunks = [next(flat) for _ in chunks]
+    header = _uint64s(3 + len(chunks)).pack(
+        len(chunks), size, COMPRESS_CHUNK_SIZE, *[len(x) for x in chunks])
+    if len(header) + sum(len(x) for x in chunks) >= size:
+      continue
+    specs[i] = ('compressed', codec, specs[i])
+    buffers[index] = ((header, *chunks), False)
+
+
+def _decompress(codec, buffer):
+  # Decompresses the chunks of a leaf in parallel into an aligned buffer.
+  decompress = CODECS[codec][1]
+  count, size, chunksize = _uint64s(3).unpack(buffer[:24])
+  sizes = _uint64s(count).unpack(buffer[24: 24 + 8 * count])
+  output = bufferlib.empty(size)
+  def fn(start, stop, index):
+    chunk = decompress(buffer[start: stop])
+    output[index * chunksize: index * chunksize + len(chunk)] = (
+        np.frombuffer(chunk, np.uint8))
+  limits = np.cumsum([24 + 8 * count, *sizes]).tolist()
+  _parallel(fn, list(zip(limits[:-1], limits[1:], range(count))))
+  return memoryview(output.data)
+
+
+def _parallel(fn, args):
+  # The codecs release the GIL, so large inputs are processed in threads. The
+  # threads only live for the duration of the call so that they cannot block
+  # the interpreter from exiting.
+  if len(args) <= 1:
+    return [fn(*x) for x in args]
+  workers = min(len(args), os.cpu_count() or 1)
+  with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+    return list(pool.map(fn, *zip(*args)))
+
+
+def _ragged(value):
+  if not isinstance(value, list) or len(value) < RAGGED_MIN_LENGTH:
+    return False
+  first = value[0]
+  if not isinstance(first, np.ndarray) or not first.ndim:
+    return False
+  dtype, shape = first.dtype, first.shape[1:]
+  if dtype == object:
+    return False
+  nbytes = 0
+  for x in value:
+    if not (
+        isinstance(x, np.ndarray) and x.ndim and
+        x.dtype == dtype and x.shape[1:] == shape):
+      return False
+    nbytes += x.nbytes
+  return nbytes <= RAGGED_MAX_ITEM_SIZE * len(value)
+
+
+def schema_cache_info():
+  return {
+      'encode': _encode_schema.cache_info(),
+      'decode': _decode_schema.cache_info(),
+  }
+
+
+@functools.lru_cache(maxsize=SCHEMA_CACHE_SIZE)
+def _encode_schema(structure, specs):
+  # The wire format stores the structure as a nested tree with None leaves.
+  structure = tuple(
+      (dict, node[1]) if node and node[0] not in (list, tuple) else node
+      for node in structure)
+  treedef = tree_unflatten([None] * structure.count(None), structure)
+  return msgpack.packb(treedef), msgpack.packb(specs)
+
+
+@functools.lru_cache(maxsize=SCHEMA_CACHE_SIZE)
+def _decode_schema(treedef, specs):
+  _, structure = tree_flatten(msgpack.unpackb(treedef))
   specs = msgpack.unpackb(specs)
-  leaves = []
-  for spec, buffer in zip(specs, buffers):
-    if spec[0] == 'none':
-      assert buffer == b'\x00'
-      leaves.append(None)
-    elif spec[0] == 'utf8':
-      leaves.append(bytes(buffer).decode('utf-8'))
-    elif spec[0] == 'bytes':
-      leaves.append(buffer)
-    elif spec[0] == 'array':
-      shape, dtype = spec[1:]
-      leaves.append(np.frombuffer(buffer, dtype).reshape(shape))
-    elif spec[0] == 'sharray':
-      assert buffer == b'\x00'
-      leaves.append(sharray.SharedArray(*spec[1:]))
+  return specs, structure
+
+
+@functools.lru_cache(maxsize=SCHEMA_CACHE_SIZE)
+def _lazy_plan(treedef, specs):
+  # Precomputes the size of each subtree in the flat structure, the leaf index
+  # of each leaf position, and the first buffer and inline value of each leaf,
+  # so that lazy unpacking can decode any single leaf directly.
+  specs, structure = _decode_schema(treedef, specs)
+  spans = [1] * len(structure)
+  stack = []
+  for pos in reversed(range(len(structure))):
+    node = structure[pos]
+    if node is not None:
+      size = node[1] if isinstance(node[1], int) else len(node[1])
+      for _ in range(size):
+        spans[pos] += stack.pop()
+    stack.append(spans[pos])
+  positions = [i for i, node in enumerate(structure) if node is None]
+  leaves = {pos: index for index, pos in enumerate(positions)}
+  offsets, buf, val = [], 0, 0
+  for spec in specs:
+    offsets.append((buf, val))
+    if spec[0] == 'inline':
+      val += 1
+    elif spec[0] == 'delta':
+      buf, val = buf + 2, val + 1
     else:
-      raise NotImplementedError(spec)
-  data = tree_unflatten(leaves, treedef)
-  return data
+      buf += 2 if spec[0] == 'ragged' else 1
+  deltas = [pos for pos in positions if specs[leaves[pos]][0] == 'delta']
+  return types.SimpleNamespace(
+      specs=specs, structure=structure, spans=spans, leaves=leaves,
+      offsets=offsets, deltas=deltas)
+
+
+@functools.lru_cache(maxsize=64)
+def _uint64s(length):
+  return struct.Struct('<' + ('Q' * length))
 
 
 def tree_map(fn, *trees, isleaf=None):
@@ -103,15 +778,71 @@ def tree_map(fn, *trees, isleaf=None):
 
 
 def tree_flatten(tree, isleaf=None):
-  leaves = []
-  tree_map(lambda x: leaves.append(x), tree, isleaf=isleaf)
-  structure = tree_map(lambda x: None, tree, isleaf=isleaf)
-  return tuple(leaves), structure
+  # Flattens the tree in a single iterative pass. The structure is a flat
+  # tuple of nodes in pre-order, where None marks a leaf, (list, n) and (tuple,
+  # n) mark sequences with n children, and (type, keys) marks mappings. The
+  # structure is hashable, so it can be compared and used as a cache key.
+  leaves, structure = [], []
+  stack = [tree]
+  pop, push, extend = stack.pop, structure.append, stack.extend
+  while stack:
+    node = pop()
+    if isleaf and isleaf(node):
+      pass
+    elif isinstance(node, (list, LazyList)):
+      push((list, len(node)))
+      extend(reversed(node))
+      continue
+    elif isinstance(node, tuple):
+      push((tuple, len(node)))
+      extend(reversed(node))
+      continue
+    elif isinstance(node, (dict, LazyDict)):
+      keys = tuple(node.keys())
+      push((dict, keys))
+      extend([node[k] for k in reversed(keys)])
+      continue
+    elif hasattr(node, 'keys') and hasattr(node, 'get'):
+      keys = tuple(node.keys())
+      push((type(node), keys))
+      extend([node[k] for k in reversed(keys)])
+      continue
+    leaves.append(node)
+    push(None)
+  return tuple(leaves), tuple(structure)
 
 
 def tree_unflatten(leaves, structure):
-  leaves = iter(tuple(leaves))
-  return tree_map(lambda x: next(leaves), structure)
+  # Rebuilds the tree bottom-up by walking the pre-order structure backwards,
+  # so that the children of each node are on top of the stack in reverse
+  # order by the time the node is reached.
+  leaves = tuple(leaves)
+  index = len(leaves)
+  stack = []
+  push = stack.append
+  for node in reversed(structure):
+    if node is None:
+      index -= 1
+      push(leaves[index])
+      continue
+    kind, arg = node
+    size = arg if kind is list or kind is tuple else len(arg)
+    if size:
+      children = stack[-size:]
+      del stack[-size:]
+      children.reverse()
+    else:
+      children = []
+    if kind is list:
+      push(children)
+    elif kind is tuple:
+      push(tuple(children))
+    elif kind is dict:
+      push(dict(zip(arg, children)))
+    else:
+      push(kind(dict(zip(arg, children))))
+  assert index == 0 and len(stack) == 1, (index, len(stack))
+  return stack[0]
 
 
 def tree_equals(xs, ys):
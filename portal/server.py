@@ -1,23 +1,53 @@
 import collections
 import concurrent.futures
+import functools
 import time
 import types
 
+from . import buffers
 from . import packlib
 from . import poollib
 from . import server_socket
+from . import shmem_socket
 from . import thread
 
 
+STATUS_OK = bytes(8)
+
+
 class Server:
 
-  def __init__(self, port, name='Server', workers=1, errors=True, **kwargs):
-    self.socket = server_socket.ServerSocket(port, name, **kwargs)
+  def __init__(
+      self, port, name='Server', workers=1, errors=True, compress=None,
+      compress_min=packlib.COMPRESS_MIN_SIZE, sendfile=False,
+      version=packlib.VERSION, **kwargs):
+    assert compress is None or compress in packlib.CODECS, compress
+    shmem = str(port).startswith('shm://')
+    if shmem:
+      self.socket = shmem_socket.ShmemServerSocket(port, name, **kwargs)
+    else:
+      self.socket = server_socket.ServerSocket(port, name, **kwargs)
     self.loop = thread.Thread(self._loop, name=f'{name}Loop')
     self.methods = {}
     self.jobs = set()
     self.workers = workers
     self.errors = errors
+    # Arrays mapped from files are sent with sendfile(), which the shared
+    # memory transport cannot use.
+    self.packkw = dict(
+        compress=compress, compress_min=compress_min,
+        sendfile=sendfile and not shmem, version=version)
+    self.arena = buffers.Arena()
+    self.deltas = packlib.DeltaDecoder()
+    # Partial requests of clients with multiple streams count against the
+    # receive budget of the socket.
+    self.stripes = buffers.Stripes(
+        self.socket.options.max_msg_size,
+        getattr(self.socket, 'recvbudget', None),
+        lambda: self.socket.connections)
+    # Requests count against the receive budget until their job finishes, so
+    # that the socket stops reading while the workers fall behind.
+    self.recvbudget = buffers.Budget(self.socket.options.max_recv_bytes)
     self.running = False
     self.pool = poollib.ThreadPool(workers, 'default_pool')
     self.postfn_pool = poollib.ThreadPool(1, 'postfn')
@@ -26,7 +56,7 @@ class Server:
     self.metrics = dict(send=0, recv=0, time=time.time())
     self.pools = [self.pool, self.postfn_pool]
 
-  def bind(self, name, workfn, postfn=None, workers=0):
+  def bind(self, name, workfn, postfn=None, workers=0, lazy=False):
     assert not self.running
     assert name not in self.methods, name
     if workers:
@@ -37,7 +67,7 @@ class Server:
     requests = collections.deque()
     available = (workers or self.workers) + 1
     self.methods[name] = types.SimpleNamespace(
-        workfn=workfn, postfn=postfn, pool=pool,
+        workfn=workfn, postfn=postfn, pool=pool, lazy=lazy,
         requests=requests, available=available)
 
   def start(self, block=True):
@@ -88,41 +118,63 @@ class Server:
     methods = list(self.methods.values())
     pending = 0
     while self.running or pending:
+      self.stripes.expire()
       while True:  # Loop syntax used to break on error.
         if not self.running:  # Do not accept further requests.
           break
+        if self.recvbudget.full():
+          break
         try:
           addr, data = self.socket.recv(timeout=0.0001)
         except TimeoutError:
           break
+        size = len(data)
         if len(data) < 8:
           self._error(addr, bytes(8), 1, 'Message too short')
           break
+        if bytes(data[:8]) == buffers.STRIPE_MARKER:
+          # Large requests of clients with multiple streams arrive in stripes
+          # over several connections and are handled once complete. The
+          # response goes to the connection of the last stripe.
+          try:
+            data = self.stripes.add(addr, data)
+          except Exception:
+            self._error(addr, bytes(8), 2, 'Could not decode message')
+            break
+          if data is None:
+            break
         reqnum, data = bytes(data[:8]), data[8:]
         try:
           strlen = int.from_bytes(data[:8], 'little', signed=False)
           name = bytes(data[8: 8 + strlen]).decode('utf-8')
-          data = packlib.unpack(data[8 + strlen:])
         except Exception:
           self._error(addr, reqnum, 2, 'Could not decode message')
           break
         if name not in self.methods:
           self._error(addr, reqnum, 3, f'Unknown method {name}')
           break
-        self.metrics['recv'] += 1
         method = self.methods[name]
-        method.requests.append((addr, reqnum, data))
+        try:
+          data = packlib.unpack(
+              data[8 + strlen:], lazy=method.lazy, delta=self.deltas)
+        except Exception:
+          self._error(addr, reqnum, 2, 'Could not decode message')
+          break
+        self.metrics['recv'] += 1
+        method.requests.append((addr, reqnum, data, size))
+        self.recvbudget.add(size)
         pending += 1
         break  # We do not actually want to loop.
 
       for method in methods:
         if method.requests and method.available:
           method.available -= 1
-          addr, reqnum, data = method.requests.popleft()
+          addr, reqnum, data, size = method.requests.popleft()
           job = method.pool.submit(method.workfn, *data)
           job.method = method
           job.addr = addr
           job.reqnum = reqnum
+          job.size = size
           self.jobs.add(job)
           if method.postfn:
             self.postfn_inp.append(job)
@@ -134,13 +186,19 @@ class Server:
           data = job.result()
           if job.method.postfn:
             data, _ = data
-          data = packlib.pack(data)
-          status = int(0).to_bytes(8, 'little', signed=False)
-          self.socket.send(job.addr, job.reqnum, status, *data)
+          # The response prefix and header are written into a block that is
+          # reused once the response has been sent.
+          block = self.arena.acquire()
+          block[:8] = job.reqnum
+          block[8:16] = STATUS_OK
+          data = packlib.pack_into(block, data, 16, **self.packkw)
+          release = functools.partial(self.arena.release, block)
+          self.socket.send(job.addr, *data, ondone=release)
           self.metrics['send'] += 1
         except Exception as e:
           self._error(job.addr, job.reqnum, 4, f'Error in server method: {e}')
         finally:
+          self.recvbudget.release(job.size)
           if not job.method.postfn:
             job.method.available += 1
             pending -= 1
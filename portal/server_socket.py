@@ -1,27 +1,66 @@
 import collections
 import dataclasses
+import itertools
 import os
 import queue
 import selectors
 import socket
+import threading
 
 from . import buffers
 from . import contextlib
 from . import thread
+from . import utils
 
 
 class Connection:
 
-  def __init__(self, sock, addr):
+  def __init__(self, sock, addr, shard=None):
     self.sock = sock
     self.addr = addr
+    self.shard = shard
     self.recvbuf = None
-    self.sendbufs = collections.deque()
+    self.sendbufs = buffers.SendQueue()
+    self.zerocopy = None
+    self.events = 0
+    self.blocked = False
+    self.paused = False
+    self.closed = False
 
   def fileno(self):
     return self.sock.fileno()
 
 
+class Shard:
+
+  def __init__(self, index):
+    self.index = index
+    self.notifier = utils.Notifier()
+    self.sel = selectors.DefaultSelector()
+    self.sel.register(self.notifier, selectors.EVENT_READ, data='signal')
+    self.conns = {}
+    self.incoming = collections.deque()  # Accepted by another shard.
+    # Connections with queued messages, split into those that can be written
+    # to and those waiting for the socket to become writable again, so that
+    # the loop does not need to look at idle connections.
+    self.ready = set()
+    self.blocked = set()
+    # Connections that are not read from while the receive budget is full.
+    self.paused = set()
+
+  def signal(self):
+    self.notifier.set()
+
+  def sending(self):
+    return bool(self.ready or self.blocked)
+
+  def close(self):
+    [conn.sock.close() for conn in self.conns.values()]
+    [conn.sock.close() for conn in self.incoming]
+    self.sel.close()
+    self.notifier.close()
+
+
 @dataclasses.dataclass
 class Options:
 
@@ -30,6 +69,15 @@ class Options:
   max_msg_size: int = 4 * 1024 ** 3
   max_recv_queue: int = 4096
   max_send_queue: int = 4096
+  max_recv_bytes: int = 0
+  max_send_bytes: int = 0
+  pool_max_bytes: int = 0
+  pool_prefault: bool = False
+  pool_hugepages: bool = False
+  zerocopy: bool = False
+  zerocopy_min: int = buffers.ZEROCOPY_MIN_SIZE
+  chunk_size: int = 0
+  loops: int = 1
   logging: bool = True
   logging_color: str = 'blue'
 
@@ -37,35 +85,72 @@ class Options:
 class ServerSocket:
 
   def __init__(self, port, name='Server', **kwargs):
-    if isinstance(port, str):
+    # Addresses of the form unix:///path/to/socket select a Unix domain socket
+    # for processes on the same machine instead of a TCP socket.
+    self.path = None
+    if isinstance(port, str) and port.startswith('unix://'):
+      self.path = port[len('unix://'):]
+    elif isinstance(port, str):
       assert '://' not in port, port
       port = int(port.rsplit(':', 1)[-1])
     self.name = name
     self.options = Options(**{**contextlib.context.serverkw, **kwargs})
-    if self.options.ipv6:
-      self.sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-      self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
-      self.addr = (self.options.host or '::', port, 0, 0)
+    if self.path:
+      utils.remove_socket(self.path)
+      self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.addr = (self.path, '')
+      self._log(f'Binding to {port}')
+      self.sock.bind(self.path)
     else:
-      self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      self.addr = (self.options.host or '0.0.0.0', port)
-    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    # self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # TODO
-    self._log(f'Binding to {self.addr[0]}:{self.addr[1]}')
-    self.sock.bind(self.addr)
+      if self.options.ipv6:
+        self.sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        self.addr = (self.options.host or '::', port, 0, 0)
+      else:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addr = (self.options.host or '0.0.0.0', port)
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      # self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # TODO
+      self._log(f'Binding to {self.addr[0]}:{self.addr[1]}')
+      self.sock.bind(self.addr)
     self.sock.setblocking(False)
     self.sock.listen(8192)
-    self.get_signal, self.set_signal = os.pipe()
-    self.sel = selectors.DefaultSelector()
-    self.sel.register(self.get_signal, selectors.EVENT_READ, data='signal')
-    self.sel.register(self.sock, selectors.EVENT_READ, data=None)
-    self._log(f'Listening at {self.addr[0]}:{self.addr[1]}')
+    # Connections are distributed across multiple event loop threads, each
+    # with its own selector, that all feed into the same receive queue. The
+    # first loop also accepts new connections.
+    assert self.options.loops >= 1, self.options.loops
+    self.shards = [Shard(i) for i in range(self.options.loops)]
+    self.shards[0].sel.register(self.sock, selectors.EVENT_READ, data=None)
+    self.assign = itertools.cycle(self.shards)
+    if self.path:
+      self._log(f'Listening at {port}')
+    else:
+      self._log(f'Listening at {self.addr[0]}:{self.addr[1]}')
+    # Unix domain clients have no address of their own, so they are told
+    # apart by a connection number.
+    self.counter = itertools.count(1)
     self.conns = {}
+    self.numsending = 0
+    self.lock = threading.Lock()
+    # Byte budgets for the messages in the receive queue and the messages that
+    # have not been written to the sockets yet. Senders wait for the send
+    # budget and connections are not read from while the receive budget is
+    # full.
+    self.sendbudget = buffers.Budget(self.options.max_send_bytes)
+    self.recvbudget = buffers.Budget(self.options.max_recv_bytes)
+    # When enabled, large messages are received into buffers that are reused
+    # once the application has released them.
+    self.pool = buffers.Pool(
+        maxbytes=self.options.pool_max_bytes,
+        prefault=self.options.pool_prefault,
+        hugepages=self.options.pool_hugepages)
     self.recvq = queue.Queue()  # [(addr, bytes)]
     self.reading = True
     self.running = True
     self.error = None
-    self.thread = thread.Thread(self._loop, name=f'{name}Loop', start=True)
+    self.threads = [
+        thread.Thread(self._loop, shard, name=f'{name}Loop', start=True)
+        for shard in self.shards]
 
   @property
   def connections(self):
@@ -76,107 +161,232 @@ class ServerSocket:
       raise self.error
     assert self.running
     try:
-      return self.recvq.get(block=(timeout != 0), timeout=timeout)
+      addr, data = self.recvq.get(block=(timeout != 0), timeout=timeout)
     except queue.Empty:
+      # The budget may also be released outside of the queue, for example by
+      # the reassembly of striped requests.
+      self._wake()
       raise TimeoutError
+    self.recvbudget.release(len(data))
+    self._wake()
+    return addr, data
 
-  def send(self, addr, *data):
+  def send(self, addr, *data, ondone=None, timeout=None, priority=0):
     if self.error:
       raise self.error
     assert self.running
-    if self._numsending() > self.options.max_send_queue:
+    if self.numsending > self.options.max_send_queue:
       raise RuntimeError('Too many outgoing messages enqueued')
     maxsize = self.options.max_msg_size
     try:
-      self.conns[addr].sendbufs.append(
-          buffers.SendBuffer(*data, maxsize=maxsize))
-      os.write(self.set_signal, bytes(1))
+      conn = self.conns[addr]
     except KeyError:
       self._log('Dropping message to disconnected client')
+      return
+    # Messages larger than the chunk size are sent in chunks that take turns
+    # with other messages of the same priority.
+    sendbuf = buffers.SendBuffer(
+        *data, maxsize=maxsize, ondone=ondone,
+        chunksize=self.options.chunk_size, priority=priority)
+    self.sendbudget.acquire(sendbuf.size, timeout)
+    with self.lock:
+      self.numsending += 1
+    conn.sendbufs.append(sendbuf)
+    conn.shard.ready.add(conn)
+    conn.shard.signal()
 
   def shutdown(self):
     self.reading = False
 
   def close(self, timeout=None):
     self.running = False
-    self.thread.join(timeout)
-    [conn.sock.close() for conn in self.conns.values()]
+    [x.join(timeout) for x in self.threads]
+    [shard.close() for shard in self.shards]
     self.sock.close()
-    self.sel.close()
-    os.close(self.get_signal)
-    os.close(self.set_signal)
+    if self.path and os.path.exists(self.path):
+      os.unlink(self.path)
+
+  def _wake(self):
+    # Lets paused loops resume reading once the receive budget has space.
+    for shard in self.shards:
+      if shard.paused and not self.recvbudget.full():
+        shard.signal()
 
-  def _loop(self):
-    writing = False
+  def _loop(self, shard):
     try:
-      while self.running or self._numsending():
-        for key, mask in self.sel.select(timeout=0.2):
+      while self.running or shard.sending():
+        timeout = 0 if shard.ready else 0.2
+        for key, mask in shard.sel.select(timeout=timeout):
           if key.data == 'signal':
-            writing = True
-            os.read(self.get_signal, 1)
-          elif key.data is None and self.reading:
-            assert mask & selectors.EVENT_READ
-            self._accept(key.fileobj)
-          elif mask & selectors.EVENT_READ and self.reading:
-            self._recv(key.data)
-        if not writing:
-          continue
-        pending = [conn for conn in self.conns.values() if conn.sendbufs]
-        for conn in pending:
-          try:
-            conn.sendbufs[0].send(conn.sock)
-            if conn.sendbufs[0].done():
-              conn.sendbufs.popleft()
-              if not any(conn.sendbufs for conn in pending):
-                writing = False
-          except BlockingIOError:
-            pass
-          except ConnectionResetError:
-            # The client is gone but we may have buffered messages left
-            # to read, so we keep the socket open until recv() fails.
-            pass
+            shard.notifier.clear()
+            while shard.incoming:
+              self._register(shard.incoming.popleft())
+            if shard.paused and not self.recvbudget.full():
+              for conn in list(shard.paused):
+                self._resume(conn)
+          elif key.data is None:
+            if self.reading:
+              assert mask & selectors.EVENT_READ
+              self._accept(key.fileobj)
+          else:
+            # Completions of zero-copy sends arrive on the error queue,
+            # which selectors report as readable, writable, or both.
+            if key.data.zerocopy and key.data.zerocopy.active():
+              key.data.zerocopy.reap(key.data.sock)
+            if mask & selectors.EVENT_WRITE and key.data.blocked:
+              self._unblock(key.data)
+            if mask & selectors.EVENT_READ and self.reading:
+              if self.recvbudget.full():
+                self._pause(key.data)
+              else:
+                self._recv(key.data)
+        # Senders may add connections meanwhile, so we iterate over a copy.
+        for conn in list(shard.ready):
+          self._send(conn)
     except Exception as e:
       self.error = e
 
+  def _send(self, conn):
+    if conn.closed:  # Disconnected before the message was enqueued.
+      conn.shard.ready.discard(conn)
+      self._drop(conn)
+      return
+    if conn.blocked:  # Enqueued while waiting for the socket.
+      conn.shard.ready.discard(conn)
+      return
+    before = conn.sendbufs.removed
+    try:
+      self.sendbudget.release(buffers.sendmany(
+          conn.sock, conn.sendbufs, zerocopy=conn.zerocopy))
+    except BlockingIOError:
+      self._block(conn)
+    except ConnectionResetError:
+      # The client is gone but we may have buffered messages left
+      # to read, so we keep the socket open until recv() fails.
+      pass
+    sent = conn.sendbufs.removed - before
+    if sent:
+      with self.lock:
+        self.numsending -= sent
+    if not conn.sendbufs:
+      conn.shard.ready.discard(conn)
+      if conn.sendbufs:  # A message was enqueued concurrently.
+        conn.shard.ready.add(conn)
+
+  def _block(self, conn):
+    # The socket buffer is full, so we wait until it becomes writable instead
+    # of trying again in every iteration.
+    conn.shard.ready.discard(conn)
+    if conn.blocked:
+      return
+    conn.blocked = True
+    conn.shard.blocked.add(conn)
+    self._update(conn)
+
+  def _unblock(self, conn):
+    conn.blocked = False
+    conn.shard.blocked.discard(conn)
+    conn.shard.ready.add(conn)
+    self._update(conn)
+
+  def _pause(self, conn):
+    conn.paused = True
+    conn.shard.paused.add(conn)
+    self._update(conn)
+
+  def _resume(self, conn):
+    conn.paused = False
+    conn.shard.paused.discard(conn)
+    self._update(conn)
+
+  def _update(self, conn):
+    # Registers the socket for the events it is currently waiting for.
+    events = 0
+    events |= 0 if conn.paused else selectors.EVENT_READ
+    events |= selectors.EVENT_WRITE if conn.blocked else 0
+    if events == conn.events:
+      return
+    if not conn.events:
+      conn.shard.sel.register(conn.sock, events, data=conn)
+    elif not events:
+      conn.shard.sel.unregister(conn.sock)
+    else:
+      conn.shard.sel.modify(conn.sock, events, data=conn)
+    conn.events = events
+
   def _accept(self, sock):
     sock, addr = sock.accept()
+    if self.path:
+      addr = (self.path, next(self.counter))
+      # The default buffer of Unix sockets is small, so that large messages
+      # would need many more system calls than over the TCP loopback.
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 ** 2)
     self._log(f'Accepted connection from {addr[0]}:{addr[1]}')
     sock.setblocking(False)
-    conn = Connection(sock, addr)
-    self.sel.register(sock, selectors.EVENT_READ, data=conn)
-    self.conns[addr] = conn
+    conn = Connection(sock, addr, next(self.assign))
+    # Large buffers are sent with MSG_ZEROCOPY where the socket supports it.
+    if self.options.zerocopy:
+      conn.zerocopy = buffers.ZeroCopy(sock, self.options.zerocopy_min)
+    if conn.shard is self.shards[0]:
+      self._register(conn)
+    else:
+      # Selectors are not shared between threads, so the owning loop
+      # registers the connection itself.
+      conn.shard.incoming.append(conn)
+      conn.shard.signal()
+
+  def _register(self, conn):
+    self._update(conn)
+    conn.shard.conns[conn.addr] = conn
+    self.conns[conn.addr] = conn
 
   def _recv(self, conn):
-    if not conn.recvbuf:
-      conn.recvbuf = buffers.RecvBuffer(maxsize=self.options.max_msg_size)
+    if conn.recvbuf is None:
+      conn.recvbuf = buffers.RecvStream(
+          maxsize=self.options.max_msg_size, pool=self.pool)
     try:
       conn.recvbuf.recv(conn.sock)
+    except BlockingIOError:
+      # Readable because of zero-copy completions but without data.
+      return
     except OSError as e:
       # For example:
       # - ConnectionResetError
       # - TimeoutError: [Errno 110] Connection timed out
       self._disconnect(conn, e)
       return
-    if conn.recvbuf.done():
+    for msg in conn.recvbuf.results():
       if self.recvq.qsize() > self.options.max_recv_queue:
         raise RuntimeError('Too many incoming messages enqueued')
-      self.recvq.put((conn.addr, conn.recvbuf.result()))
-      conn.recvbuf = None
+      self.recvbudget.add(len(msg))
+      self.recvq.put((conn.addr, msg))
 
   def _disconnect(self, conn, e):
     detail = f'{type(e).__name__}'
     detail = f'{detail}: {e}' if str(e) else detail
     self._log(f'Closed connection to {conn.addr[0]}:{conn.addr[1]} ({detail})')
-    conn = self.conns.pop(conn.addr)
+    conn.closed = True
+    self.conns.pop(conn.addr)
+    conn.shard.conns.pop(conn.addr)
+    conn.shard.ready.discard(conn)
+    conn.shard.blocked.discard(conn)
+    conn.shard.paused.discard(conn)
     if conn.sendbufs:
-      count = len(conn.sendbufs)
-      conn.sendbufs.clear()
+      count = self._drop(conn)
       self._log(f'Dropping {count} messages to disconnected client')
-    self.sel.unregister(conn.sock)
+    if conn.events:
+      conn.shard.sel.unregister(conn.sock)
     conn.sock.close()
 
-  def _numsending(self):
-    return sum(len(x.sendbufs) for x in self.conns.values())
+  def _drop(self, conn):
+    count, size = 0, 0
+    while conn.sendbufs:
+      count += 1
+      size += conn.sendbufs.popleft().unsent()
+    with self.lock:
+      self.numsending -= count
+    self.sendbudget.release(size)
+    return count
 
   def _log(self, *args, **kwargs):
     if not self.options.logging:
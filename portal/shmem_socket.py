@@ -0,0 +1,604 @@
+import collections
+import dataclasses
+import itertools
+import mmap
+import os
+import platform
+import queue
+import select
+import selectors
+import socket
+import struct
+import tempfile
+import threading
+import time
+import weakref
+
+import numpy as np
+
+from . import buffers
+from . import client_socket
+from . import contextlib
+from . import server_socket
+from . import thread
+from . import utils
+
+
+# Each connection owns a shared memory block with one ring buffer per
+# direction. A ring starts with its write counter, its read counter, and a flag
+# that tells whether its reader is blocked, each on its own cache line. The
+# counters are byte offsets that only grow, so the position inside the ring is
+# the counter modulo the ring size. The Unix socket at the address is only used
+# to set up connections, to detect disconnects, and to wake up blocked readers.
+WRITE, READ, ASLEEP = 0, 8, 16
+CONTROL = 192
+
+# Frames start with a header that holds the payload length, so that payloads
+# start at a multiple of 64 bytes. A header holding WRAP tells the reader that
+# the remainder of the ring is skipped and the next frame starts at the front.
+# Messages larger than half the ring are sent as multiple frames, whose headers
+# also hold the total length of the message, and are copied out by the reader.
+HEADER = 64
+WRAP = 2 ** 64 - 1
+
+# Sent by the server together with the file descriptor of the shared memory
+# when a client connects: the size of each ring.
+HELLO = struct.Struct('<Q')
+
+# Readers poll for this many seconds before blocking on the socket. Spinning
+# only helps when the other process runs on another core at the same time.
+SPIN = 5e-5 if (os.cpu_count() or 1) > 1 else 0.0
+
+# The rings publish frames with plain stores and rely on other cores seeing
+# them in program order. Python offers no memory fences, so the transport is
+# limited to x86, whose memory model guarantees this ordering.
+ORDERED = platform.machine().lower() in (
+    'x86_64', 'amd64', 'i386', 'i686', 'x86')
+
+
+def _check_platform():
+  if not ORDERED:
+    raise RuntimeError(
+        'The shared memory transport requires x86 memory ordering, which '
+        f'{platform.machine()} does not guarantee.')
+
+
+class Ring:
+
+  # Single producer and single consumer queue of frames in shared memory.
+  # Payloads up to the copy size are copied out right away. Larger payloads
+  # are returned as views into the ring and their space is reused once the
+  # last view into them has been garbage collected. To ensure that the writer
+  # can always make progress, at most half of the ring is held by views and
+  # payloads beyond that are copied out as well.
+
+  def __init__(self, mem, offset, size, doorbell):
+    assert size % 64 == 0 and size >= 4 * HEADER, size
+    self.size = size
+    self.ctrl = np.ndarray(CONTROL // 8, np.uint64, mem, offset)
+    self.data = np.ndarray(size, np.uint8, mem, offset + CONTROL)
+    self.words = self.data.view(np.uint64)
+    self.doorbell = doorbell
+    self.cursor = int(self.ctrl[READ])
+    self.pending = collections.deque()
+    self.partial = None
+    self.lock = threading.Lock()
+
+  def frames(self, parts, length):
+    limit = self.size // 2 - HEADER
+    if length <= limit:
+      return [(parts, length, 0)]
+    return [(group, size, length) for group, size in _split(parts, limit)]
+
+  def write(self, parts, length, alive):
+    # Blocks until the whole message has been written. Used by clients, whose
+    # sends only block the calling thread.
+    with self.lock:
+      for frame in self.frames(parts, length):
+        while not self._offer(*frame):
+          if not alive():
+            raise ConnectionResetError
+          time.sleep(0.0001)
+
+  def offer(self, frame):
+    # Writes the frame if the ring has space for it and returns whether it
+    # did, so that the server never waits for a slow reader.
+    with self.lock:
+      return self._offer(*frame)
+
+  def read(self, copysize):
+    while True:
+      if self.cursor == int(self.ctrl[WRITE]):
+        return None
+      pos = self.cursor % self.size
+      length = int(self.words[pos // 8])
+      if length == WRAP:
+        self.cursor += self.size - pos
+        self._release(self._track(self.cursor))
+        continue
+      total = int(self.words[pos // 8 + 1])
+      self.cursor += HEADER + -(-length // 64) * 64
+      payload = self.data[pos + HEADER: pos + HEADER + length]
+      entry = self._track(self.cursor)
+      if total:
+        if self.partial is None:
+          self.partial = [buffers.empty(total), 0]
+        result, filled = self.partial
+        result[filled: filled + length] = payload
+        self._release(entry)
+        self.partial[1] += length
+        if self.partial[1] < total:
+          continue
+        self.partial = None
+        return memoryview(result.data)
+      held = self.cursor - int(self.ctrl[READ])
+      if length <= copysize or held > self.size // 2:
+        result = buffers.empty(length)
+        result[:] = payload
+        self._release(entry)
+        return memoryview(result.data)
+      # The memoryview keeps the payload array alive for as long as any array
+      # unpacked from the message exists, so its finalizer frees the space.
+      weakref.finalize(payload, self._release, entry)
+      return memoryview(payload)
+
+  def _offer(self, parts, length, total):
+    need = HEADER + -(-length // 64) * 64
+    write = int(self.ctrl[WRITE])
+    pos = write % self.size
+    skip = self.size - pos if pos + need > self.size else 0
+    if self.size - (write - int(self.ctrl[READ])) < skip + need:
+      return False
+    if skip:
+      self.words[pos // 8] = WRAP
+      write += skip
+      self.ctrl[WRITE] = write
+      pos = 0
+    start = pos + HEADER
+    for part in parts:
+      part = np.frombuffer(part, np.uint8)
+      self.data[start: start + len(part)] = part
+      start += len(part)
+    self.words[pos // 8] = length
+    self.words[pos // 8 + 1] = total
+    # Publishing the frame after writing it relies on stores becoming visible
+    # to other cores in program order, which is why the transport checks for
+    # x86 before it creates any rings.
+    self.ctrl[WRITE] = write + need
+    if self.ctrl[ASLEEP]:
+      self.doorbell()
+    return True
+
+  def _track(self, end):
+    entry = [end, False]
+    with self.lock:
+      self.pending.append(entry)
+    return entry
+
+  def _release(self, entry):
+    # Frames can be released in any order but the read counter only moves
+    # past frames that have all been released.
+    with self.lock:
+      entry[1] = True
+      while self.pending and self.pending[0][1]:
+        self.ctrl[READ] = self.pending.popleft()[0]
+
+
+@dataclasses.dataclass
+class ServerOptions(server_socket.Options):
+
+  ring_size: int = 64 * 1024 ** 2
+  copy_size: int = 64 * 1024
+  spin: float = SPIN
+  logging_color: str = 'blue'
+
+
+# Options that only exist for the shared memory transport.
+KEYS = ('ring_size', 'copy_size', 'spin')
+
+
+class Connection:
+
+  def __init__(self, sock, addr, mem, size):
+    self.sock = sock
+    self.addr = addr
+    self.alive = True
+    self.backlog = collections.deque()
+    self.lock = threading.Lock()
+    doorbell = lambda: _ring(sock)
+    self.inbox = Ring(mem, 0, size, doorbell)
+    self.outbox = Ring(mem, CONTROL + size, size, doorbell)
+
+  def fileno(self):
+    return self.sock.fileno()
+
+
+class ShmemServerSocket:
+
+  def __init__(self, port, name='Server', **kwargs):
+    assert str(port).startswith('shm://'), port
+    _check_platform()
+    self.path = str(port)[len('shm://'):]
+    self.addr = (self.path, '')
+    self.name = name
+    self.options = ServerOptions(**{**contextlib.context.serverkw, **kwargs})
+    utils.remove_socket(self.path)
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._log(f'Binding to {port}')
+    self.sock.bind(self.path)
+    self.sock.setblocking(False)
+    self.sock.listen(8192)
+    self.sel = selectors.DefaultSelector()
+    self.sel.register(self.sock, selectors.EVENT_READ, data=None)
+    self._log(f'Listening at {port}')
+    self.counter = itertools.count(1)
+    self.conns = {}
+    self.active = []
+    self.waiting = set()
+    self.notifier = utils.Notifier()
+    self.sel.register(self.notifier, selectors.EVENT_READ, data=self.notifier)
+    self.turn = 0
+    self.wakeup = threading.Event()
+    self.reading = True
+    self.running = True
+    self.error = None
+    self.thread = thread.Thread(self._loop, name=f'{name}Loop', start=True)
+
+  @property
+  def connections(self):
+    return tuple(self.conns.keys())
+
+  def recv(self, timeout=None):
+    if self.error:
+      raise self.error
+    assert self.running
+    now = time.perf_counter()
+    deadline = None if timeout is None else now + timeout
+    spinning = now + self.options.spin
+    while True:
+      result = self._poll()
+      if result:
+        return result
+      now = time.perf_counter()
+      if deadline is not None and now >= deadline:
+        raise TimeoutError
+      if now < spinning:
+        continue
+      # Block until a client rings the doorbell. The timeout bounds the wait
+      # in case a doorbell was missed because the flag was set concurrently.
+      self.wakeup.clear()
+      active = self.active
+      for conn in active:
+        conn.inbox.ctrl[ASLEEP] = 1
+      result = self._poll()
+      if not result:
+        wait = 0.01 if deadline is None else min(0.01, deadline - now)
+        self.wakeup.wait(wait)
+      for conn in active:
+        conn.inbox.ctrl[ASLEEP] = 0
+      if result:
+        return result
+      spinning = time.perf_counter() + self.options.spin
+
+  def send(self, addr, *data, ondone=None):
+    if self.error:
+      raise self.error
+    assert self.running
+    conn = self.conns.get(addr)
+    if not conn:
+      self._log('Dropping message to disconnected client')
+      return
+    length = sum(memoryview(x).nbytes for x in data)
+    assert 1 <= length <= self.options.max_msg_size, length
+    # Messages that do not fit into the ring are queued and written by the
+    # loop once the client reads, so that a slow client does not block the
+    # caller from serving other clients.
+    frames = collections.deque(conn.outbox.frames(data, length))
+    with conn.lock:
+      conn.backlog.append((frames, ondone))
+    if not self._flush(conn):
+      self.notifier.set()
+
+  def shutdown(self):
+    self.reading = False
+
+  def close(self, timeout=None):
+    self.running = False
+    self.thread.join(timeout)
+    for conn in list(self.conns.values()):
+      self._disconnect(conn)
+    self.sock.close()
+    self.sel.close()
+    self.notifier.close()
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+
+  def _poll(self):
+    if not self.reading:
+      return None
+    active = self.active
+    for i in range(len(active)):
+      conn = active[(self.turn + i) % len(active)]
+      data = conn.inbox.read(self.options.copy_size)
+      if data is not None:
+        self.turn = (self.turn + i + 1) % len(active)
+        return conn.addr, data
+    return None
+
+  def _loop(self):
+    try:
+      while self.running or self.waiting:
+        # There is no event for the client reading from the ring, so the
+        # loop polls the rings of queued messages instead.
+        timeout = 0.001 if self.waiting else 0.2
+        for key, mask in self.sel.select(timeout=timeout):
+          if key.data is None:
+            self._accept(key.fileobj)
+            continue
+          if key.data is self.notifier:
+            self.notifier.clear()
+            continue
+          conn = key.data
+          try:
+            data = conn.sock.recv(4096)
+          except BlockingIOError:
+            continue
+          except OSError as e:
+            self._disconnect(conn, e)
+            continue
+          if not data:
+            self._disconnect(conn, ConnectionResetError())
+            continue
+          self.wakeup.set()
+        for conn in list(self.waiting):
+          self._flush(conn)
+    except Exception as e:
+      self.error = e
+
+  def _accept(self, sock):
+    sock, _ = sock.accept()
+    addr = (self.path, next(self.counter))
+    size = self.options.ring_size
+    # The shared memory is handed to the client as a file descriptor and has
+    # no name, so that it cannot leak.
+    fd = _anonymous(2 * (CONTROL + size))
+    try:
+      mem = mmap.mmap(fd, 2 * (CONTROL + size))
+      socket.send_fds(sock, [HELLO.pack(size)], [fd])
+    finally:
+      os.close(fd)
+    sock.setblocking(False)
+    conn = Connection(sock, addr, mem, size)
+    self.sel.register(sock, selectors.EVENT_READ, data=conn)
+    self.conns[addr] = conn
+    self.active = [*self.active, conn]
+    self._log(f'Accepted connection from {addr[0]}:{addr[1]}')
+
+  def _disconnect(self, conn, e=None):
+    if e:
+      detail = f'{type(e).__name__}'
+      detail = f'{detail}: {e}' if str(e) else detail
+      self._log(
+          f'Closed connection to {conn.addr[0]}:{conn.addr[1]} ({detail})')
+    conn.alive = False
+    with conn.lock:
+      for _, ondone in conn.backlog:
+        ondone and ondone()
+      conn.backlog.clear()
+      self.waiting.discard(conn)
+    self.conns.pop(conn.addr, None)
+    self.active = [x for x in self.active if x is not conn]
+    self.sel.unregister(conn.sock)
+    conn.sock.close()
+
+  def _flush(self, conn):
+    # Writes queued messages until the ring is full and returns whether all of
+    # them were written. The waiting set is only changed under the lock of the
+    # connection, so that it stays in sync with its backlog.
+    with conn.lock:
+      while conn.backlog:
+        frames, ondone = conn.backlog[0]
+        while frames and conn.outbox.offer(frames[0]):
+          frames.popleft()
+        if frames:
+          self.waiting.add(conn)
+          return False
+        conn.backlog.popleft()
+        # The message has been copied into the ring, so the buffers can be
+        # reused.
+        ondone and ondone()
+      self.waiting.discard(conn)
+      return True
+
+  def _log(self, *args, **kwargs):
+    if not self.options.logging:
+      return
+    contextlib.context.print(
+        self.name, *args, color=self.options.logging_color)
+
+
+@dataclasses.dataclass
+class ClientOptions(client_socket.Options):
+
+  copy_size: int = 64 * 1024
+  spin: float = SPIN
+
+
+class ShmemClientSocket(client_socket.ClientSocket):
+
+  def __init__(self, addr, name='Client', start=True, **kwargs):
+    assert str(addr).startswith('shm://'), addr
+    _check_platform()
+    self.path = str(addr)[len('shm://'):]
+    self.addr = (self.path, '')
+    self.name = name
+    self.options = ClientOptions(**{**contextlib.context.clientkw, **kwargs})
+
+    self.callbacks_recv = []
+    self.callbacks_conn = []
+    self.callbacks_disc = []
+
+    self.isconn = threading.Event()
+    self.wantconn = threading.Event()
+    self.recvq = queue.Queue()
+    self.conn = None
+    # The rings bound the size of queued messages, so the receive budget only
+    # tracks them.
+    self.recvbudget = buffers.Budget()
+    self.paused = False
+
+    self.running = True
+    self.thread = thread.Thread(self._loop, name=f'{name}Loop')
+    start and self.thread.start()
+
+  def send(self, *data, ondone=None, timeout=None):
+    assert self.running
+    self.require_connection(timeout)
+    conn = self.conn
+    length = sum(memoryview(x).nbytes for x in data)
+    assert 1 <= length <= self.options.max_msg_size, length
+    try:
+      conn.outbox.write(data, length, lambda: conn.alive)
+    except ConnectionResetError:
+      # Like with TCP sockets, messages to a lost server are dropped and can
+      # be sent again after reconnecting.
+      pass
+    # The message has been copied into the ring, so the buffers can be reused.
+    ondone and ondone()
+
+  def close(self, timeout=None):
+    self.running = False
+    self.thread.join(timeout)
+    self.thread.kill()
+
+  def _loop(self):
+    conn = None
+    while self.running:
+
+      if not conn:
+        if not self.options.autoconn and not self.wantconn.wait(timeout=0.2):
+          continue
+        conn = self._connect()
+        if not conn:
+          break
+        self.conn = conn
+        self.isconn.set()
+        if not self.options.autoconn:
+          self.wantconn.clear()
+        [x() for x in self.callbacks_conn]
+        spinning = time.perf_counter() + self.options.spin
+
+      msg = conn.inbox.read(self.options.copy_size)
+      if msg is None and time.perf_counter() < spinning:
+        continue
+      if msg is None:
+        conn.inbox.ctrl[ASLEEP] = 1
+        msg = conn.inbox.read(self.options.copy_size)
+        if msg is None:
+          # Block until the server rings the doorbell. The timeout bounds the
+          # wait in case a doorbell was missed and lets us notice shutdown.
+          readable, _, _ = select.select([conn.sock], [], [], 0.01)
+          error = None
+          try:
+            if readable and not conn.sock.recv(4096):
+              error = ConnectionResetError()
+          except BlockingIOError:
+            pass
+          except OSError as e:
+            error = e
+          if error:
+            conn.inbox.ctrl[ASLEEP] = 0
+            self._lost(conn, error)
+            conn = None
+            continue
+        conn.inbox.ctrl[ASLEEP] = 0
+        spinning = time.perf_counter() + self.options.spin
+      if msg is not None:
+        if self.recvq.qsize() > self.options.max_recv_queue:
+          raise RuntimeError('Too many incoming messages enqueued')
+        self.recvbudget.add(len(msg))
+        self.recvq.put(msg)
+        [x(msg) for x in self.callbacks_recv]
+        spinning = time.perf_counter() + self.options.spin
+
+    if conn:
+      conn.alive = False
+      conn.sock.close()
+
+  def _lost(self, conn, e):
+    detail = f'{type(e).__name__}'
+    detail = f'{detail}: {e}' if str(e) else detail
+    self._log(f'Connection to server lost ({detail})')
+    self.isconn.clear()
+    conn.alive = False
+    conn.sock.close()
+    self.conn = None
+    [x() for x in self.callbacks_disc]
+
+  def _connect(self):
+    self._log(f'Connecting to shm://{self.path}')
+    once = True
+    while self.running:
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        sock.settimeout(10)
+        sock.connect(self.path)
+        header, fds, _, _ = socket.recv_fds(sock, HELLO.size, 1)
+        if len(header) < HELLO.size or not fds:
+          raise ConnectionResetError
+        size, = HELLO.unpack(header)
+        mem = mmap.mmap(fds[0], 2 * (CONTROL + size))
+        os.close(fds[0])
+        conn = Connection(sock, self.addr, mem, size)
+        # The rings are used in the opposite directions as on the server.
+        conn.inbox, conn.outbox = conn.outbox, conn.inbox
+        sock.setblocking(False)
+        self._log('Connection established')
+        return conn
+      except OSError as e:
+        error = e
+      if once:
+        self._log(f'Still trying to connect... ({error})')
+        once = False
+      sock.close()
+      time.sleep(self.options.connect_wait)
+    return None
+
+
+def _split(parts, limit):
+  # Groups the bytes of the parts into chunks of at most the limit.
+  group, size = [], 0
+  for part in parts:
+    part = memoryview(part).cast('c')
+    while len(part):
+      take = min(limit - size, len(part))
+      group.append(part[:take])
+      part = part[take:]
+      size += take
+      if size == limit:
+        yield group, size
+        group, size = [], 0
+  if size:
+    yield group, size
+
+
+def _anonymous(size):
+  # Creates shared memory without a name in the file system.
+  if hasattr(os, 'memfd_create'):
+    fd = os.memfd_create('portal', os.MFD_CLOEXEC)
+  else:
+    fd, path = tempfile.mkstemp(prefix='portal-')
+    os.unlink(path)
+  try:
+    os.ftruncate(fd, size)
+  except OSError:
+    os.close(fd)
+    raise
+  return fd
+
+
+def _ring(sock):
+  try:
+    sock.send(b'\x01', socket.MSG_DONTWAIT)
+  except OSError:
+    pass  # The buffer is full, so the reader will wake up anyway.
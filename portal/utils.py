@@ -2,6 +2,7 @@ import ctypes
 import errno
 import os
 import socket
+import stat
 import sys
 import threading
 import time
@@ -112,6 +113,18 @@ def free_port():
   return port
 
 
+def remove_socket(path):
+  # Removes a Unix socket left over from a previous server. Other files at the
+  # path are kept, so that a mistyped address cannot delete them.
+  try:
+    mode = os.stat(path).st_mode
+  except FileNotFoundError:
+    return
+  if not stat.S_ISSOCK(mode):
+    raise FileExistsError(f'Cannot bind to {path}, which is not a socket')
+  os.unlink(path)
+
+
 def style(color=None, background=None, bold=None, underline=None, reset=None):
   if not sys.stdout.isatty():
     return ''
@@ -129,3 +142,58 @@ def style(color=None, background=None, bold=None, underline=None, reset=None):
   if background:
     parts.append(escseq('4' + str(colors[background])))
   return ''.join(parts)
+
+
+class Notifier:
+
+  """
+  Wakes up an event loop that waits on the file descriptor. Uses an eventfd
+  where available and a pipe otherwise. Notifications are coalesced, so that
+  only the first notification after the loop last cleared it results in a
+  system call and the loop drains all of them with a single read.
+  """
+
+  def __init__(self):
+    if hasattr(os, 'eventfd'):
+      self.eventfd = True
+      self.rfd = self.wfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+    else:
+      self.eventfd = False
+      self.rfd, self.wfd = os.pipe()
+      os.set_blocking(self.rfd, False)
+      os.set_blocking(self.wfd, False)
+    self.pending = False
+
+  def fileno(self):
+    return self.rfd
+
+  def set(self):
+    if self.pending:
+      return
+    self.pending = True
+    try:
+      if self.eventfd:
+        os.eventfd_write(self.wfd, 1)
+      else:
+        os.write(self.wfd, bytes(1))
+    except BlockingIOError:
+      pass  # The pipe is full, so the loop will wake up anyway.
+
+  def clear(self):
+    # The flag is reset after reading, so that a notification that arrives in
+    # between is not drained while its flag stays set. The caller needs to
+    # check for work after clearing.
+    try:
+      if self.eventfd:
+        os.eventfd_read(self.rfd)
+      else:
+        while os.read(self.rfd, 4096):
+          pass
+    except BlockingIOError:
+      pass
+    self.pending = False
+
+  def close(self):
+    os.close(self.rfd)
+    if self.wfd != self.rfd:
+      os.close(self.wfd)
@@ -0,0 +1,121 @@
+import asyncio
+
+import numpy as np
+import pytest
+import portal
+
+
+class TestAio:
+
+  @pytest.mark.parametrize('transport', ('tcp', 'unix'))
+  def test_basic(self, transport, tmp_path):
+    if transport == 'unix':
+      addr = f'unix://{tmp_path}/server.sock'
+    else:
+      addr = portal.free_port()
+    async def main():
+      server = portal.AsyncServer(addr)
+      server.bind('fn', lambda x: 2 * x)
+      async with server:
+        async with portal.AsyncClient(addr) as client:
+          assert await client.fn(21) == 42
+          result = await client.fn(np.arange(3))
+          assert (result == [0, 2, 4]).all()
+    asyncio.run(main())
+
+  def test_concurrent(self):
+    port = portal.free_port()
+    async def fn(x):
+      await asyncio.sleep(0.1)
+      return x
+    async def main():
+      server = portal.AsyncServer(port)
+      server.bind('fn', fn)
+      async with server:
+        async with portal.AsyncClient(port, maxinflight=1000) as client:
+          results = await asyncio.gather(*[client.fn(i) for i in range(1000)])
+          assert results == list(range(1000))
+    asyncio.run(asyncio.wait_for(main(), 10))
+
+  def test_sync_client(self):
+    port = portal.free_port()
+    async def main():
+      server = portal.AsyncServer(port)
+      server.bind('fn', lambda x, y: x + y)
+      async with server:
+        client = portal.Client(port, delta=True)
+        data = np.zeros((256, 1024), np.float32)
+        futures = [client.fn(data, i) for i in range(3)]
+        loop = asyncio.get_running_loop()
+        for i, future in enumerate(futures):
+          result = await loop.run_in_executor(None, future.result)
+          assert (result == i).all()
+        client.close()
+    asyncio.run(main())
+
+  def test_sync_chunks(self):
+    port = portal.free_port()
+    async def main():
+      server = portal.AsyncServer(port)
+      server.bind('fn', lambda x: x.sum())
+      async with server:
+        client = portal.Client(port, chunk_size=4096)
+        data = np.ones((256, 1024), np.float32)
+        futures = [client.fn(data[i:]) for i in range(3)]
+        loop = asyncio.get_running_loop()
+        for i, future in enumerate(futures):
+          result = await loop.run_in_executor(None, future.result)
+          assert result == data[i:].sum()
+        client.close()
+    asyncio.run(main())
+
+  def test_sync_server(self):
+    port = portal.free_port()
+    server = portal.Server(port)
+    server.bind('fn', lambda x: {'x': x, 'y': [x.sum(), 'foo']})
+    async def main():
+      async with portal.AsyncClient(port, delta=True) as client:
+        for i in range(3):
+          data = np.full((256, 1024), i, np.float32)
+          result = await client.fn(data)
+          assert (result['x'] == i).all()
+          assert result['y'] == [i * data.size, 'foo']
+    with server:
+      asyncio.run(main())
+
+  def test_error(self):
+    port = portal.free_port()
+    def fn(x):
+      raise ValueError(x)
+    async def main():
+      server = portal.AsyncServer(port, errors=False)
+      server.bind('fn', fn)
+      async with server:
+        async with portal.AsyncClient(port) as client:
+          with pytest.raises(RuntimeError) as info:
+            await client.fn('foo')
+          assert 'Error in server method: foo' in str(info.value)
+          with pytest.raises(RuntimeError) as info:
+            await client.bar()
+          assert 'Unknown method bar' in str(info.value)
+    asyncio.run(main())
+
+  def test_disconnect(self):
+    port = portal.free_port()
+    async def main():
+      server = portal.AsyncServer(port)
+      server.bind('fn', asyncio.sleep)
+      await server.start(block=False)
+      client = portal.AsyncClient(port)
+      await client.connect()
+      call = asyncio.ensure_future(client.fn(10))
+      await asyncio.sleep(0.1)
+      await server.close()
+      with pytest.raises(portal.Disconnected):
+        await call
+      server = portal.AsyncServer(port)
+      server.bind('fn', lambda x: x)
+      async with server:
+        assert await client.fn(1) == 1
+      await client.close()
+    asyncio.run(main())
@@ -1,6 +1,8 @@
+import socket
 import threading
 import time
 
+import numpy as np
 import pytest
 import portal
 
@@ -185,6 +187,109 @@ class TestClient:
     client.close()
     server.close()
 
+  @pytest.mark.parametrize('Server', SERVERS)
+  def test_budgets(self, Server):
+    port = portal.free_port()
+    budget = 1024 ** 2
+    server = Server(port, max_recv_bytes=budget, max_send_bytes=budget)
+    server.bind('fn', lambda x: x)
+    server.start(block=False)
+    client = portal.Client(port, max_send_bytes=budget, max_recv_bytes=budget)
+    data = bytes(budget // 2)
+    futures = [client.fn(data) for _ in range(16)]
+    assert all(len(x.result()) == len(data) for x in futures)
+    client.close()
+    server.close()
+
+  def test_budget_slow_workers(self):
+    port = portal.free_port()
+    budget = 1024 ** 2
+    server = portal.Server(port, max_recv_bytes=budget)
+    def fn(x):
+      time.sleep(0.2)
+      return len(x)
+    server.bind('fn', fn)
+    server.start(block=False)
+    client = portal.Client(port)
+    data = bytes(budget // 2)
+    futures = [client.fn(data) for _ in range(12)]
+    # Requests stay in the budget until their job finishes, so the server
+    # stops receiving and the socket pauses the connection. Each budget is
+    # exceeded by at most the message that filled it.
+    paused = lambda: any(shard.paused for shard in server.socket.shards)
+    deadline = time.time() + 10
+    while not paused() and time.time() < deadline:
+      time.sleep(0.01)
+    assert paused()
+    assert server.recvbudget.used < budget + len(data)
+    assert server.socket.recvbudget.used < budget + len(data)
+    assert server.stats()['requests'] <= 2
+    assert all(x.result() == len(data) for x in futures)
+    assert server.recvbudget.used == 0
+    client.close()
+    server.close()
+
+  def test_delta_reconnect(self):
+    port = portal.free_port()
+    # The first server answers the first request and then goes down while
+    # the second request, which is delta encoded against the first, is
+    # pending.
+    server = portal.ServerSocket(port)
+    client = portal.Client(port, delta=True, autoconn=True)
+    data = np.zeros((256, 1024), np.float32)
+    first = client.fn(data)
+    addr, request = server.recv(timeout=10)
+    response = portal.pack(0, offset=16)
+    server.send(addr, bytes(request[:8]), bytes(8), *response)
+    assert first.result(timeout=10) == 0
+    data = data.copy()
+    data[0] = 1
+    second = client.fn(data)
+    server.recv(timeout=10)
+    server.close()
+    server = portal.Server(port)
+    server.bind('fn', lambda x: x.sum())
+    with server:
+      with pytest.raises(portal.Disconnected):
+        second.result(timeout=10)
+      assert client.fn(data).result(timeout=10) == 1024
+    client.close()
+
+  def test_stripes_resend(self):
+    port = portal.free_port()
+    # The server only reads one message at a time, so that stripes that are
+    # sent again after a reconnect stay queued on the client.
+    server = portal.ServerSocket(port, max_recv_bytes=1)
+    client = portal.Client(port, streams=2)
+    data = np.zeros(16 * portal.buffers.STRIPE_MIN_SIZE, np.uint8)
+    future = client.fn(data)
+    stripes = dict(server.recv(timeout=10) for _ in range(2))
+    offsets = {portal.buffers.STRIPE.unpack_from(x)[3]: addr
+               for addr, x in stripes.items()}
+    # The second connection goes down, so all stripes are sent again.
+    server.conns[offsets[max(offsets)]].sock.shutdown(socket.SHUT_RDWR)
+    deadline = time.time() + 10
+    while getattr(future, 'resend', None) is not False:
+      assert time.time() < deadline
+      time.sleep(0.01)
+    # The response to the first copy arrives while the stripes are queued.
+    reqnum = portal.buffers.STRIPE.unpack_from(stripes[offsets[0]])[2]
+    response = portal.pack(0, offset=16)
+    server.send(offsets[0], reqnum.to_bytes(8, 'little'), bytes(8), *response)
+    assert future.result(timeout=10) == 0
+    block = future.block
+    released = lambda: any(x is block for x in client.arena.blocks)
+    assert future.holds and not released()
+    for _ in range(2):
+      server.recv(timeout=10)
+    deadline = time.time() + 10
+    while not released():
+      assert time.time() < deadline
+      time.sleep(0.01)
+    assert future.holds == 0
+    client.close()
+    server.close()
+
   @pytest.mark.parametrize('repeat', range(5))
   def test_client_threadsafe(self, repeat, users=16):
     port = portal.free_port()
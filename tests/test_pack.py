@@ -1,3 +1,6 @@
+import struct
+
+import msgpack
 import pytest
 import portal
 import numpy as np
@@ -19,6 +22,265 @@ class TestPack:
     restored = portal.unpack(buffer)
     assert portal.tree_equals(value, restored)
 
+  @pytest.mark.parametrize('tree', [
+      [],
+      {},
+      (1, [2, (3,)], {'a': None, 'b': {}}),
+      {f'layer{i}': {'w': i, 'b': [i, i]} for i in range(1000)},
+  ])
+  def test_tree_flatten(self, tree):
+    leaves, structure = portal.packlib.tree_flatten(tree)
+    hash(structure)
+    restored = portal.packlib.tree_unflatten(leaves, structure)
+    assert restored == tree
+    assert type(restored) == type(tree)
+
+  def test_tree_deep(self):
+    tree = 'leaf'
+    for i in range(10000):
+      tree = [tree] if i % 2 else {'x': tree}
+    leaves, structure = portal.packlib.tree_flatten(tree)
+    assert leaves == ('leaf',)
+    restored = portal.packlib.tree_unflatten(leaves, structure)
+    assert portal.packlib.tree_flatten(restored) == (leaves, structure)
+
+  @pytest.mark.parametrize('inline', (True, False))
+  def test_inline(self, inline):
+    value = (12, -3, 2 ** 63, 0.5, True, None, 'train', 'x' * 1000, b'ab')
+    buffers = portal.pack(value, align=1, inline=inline)
+    restored = portal.unpack(b''.join(buffers))
+    if inline:
+      assert len(buffers) == 1 + 2
+    # Inlined values are unpacked as the same types as array leaves.
+    expected = [np.asarray(x) for x in value[:5]] + [None, 'train']
+    assert restored[:7] == expected
+    assert [type(x) for x in restored[:7]] == [type(x) for x in expected]
+    assert [x.dtype for x in restored[:5]] == [x.dtype for x in expected[:5]]
+    assert restored[7] == value[7]
+    assert bytes(restored[8]) == value[8]
+
+  def test_ragged(self):
+    arrays = [np.full((i % 7, 3), i, np.float32) for i in range(10000)]
+    value = {'episodes': arrays, 'short': arrays[:3]}
+    buffers = portal.pack(value)
+    assert len(buffers) <= 5 + 3 * 2 + 3 * 2
+    restored = portal.unpack(b''.join(buffers))
+    assert len(restored['episodes']) == len(arrays)
+    for x, y in zip(arrays, restored['episodes']):
+      assert x.shape == y.shape and (x == y).all()
+    assert restored['episodes'][5].base is not None
+    assert portal.tree_equals(restored['short'], arrays[:3])
+
+  @pytest.mark.parametrize('value', [
+      [np.zeros(3, np.float32)] * 15 + [np.zeros(3, np.float64)],
+      [np.zeros((2, 3))] * 15 + [np.zeros((2, 4))],
+      [np.zeros(0, np.int8)] * 20,
+      [np.asarray(1)] * 20,
+  ])
+  def test_ragged_fallback(self, value):
+    restored = portal.unpack(b''.join(portal.pack(value)))
+    assert portal.tree_equals(restored, value)
+
+  @pytest.mark.parametrize('codec', sorted(portal.packlib.CODECS))
+  def test_compress(self, codec):
+    rng = np.random.default_rng(0)
+    large = np.tile(np.arange(1000, dtype=np.float32), 3000).reshape(3000, -1)
+    value = {
+        'large': large,
+        'bytes': bytes(10 ** 6),
+        'noise': rng.integers(0, 255, 10 ** 5, np.uint8),
+        'small': np.zeros(100),
+    }
+    buffers = portal.pack(value, compress=codec)
+    size = sum(len(x) for x in buffers)
+    assert size < large.nbytes / 2
+    restored = portal.unpack(b''.join(buffers))
+    assert bytes(restored.pop('bytes')) == value.pop('bytes')
+    assert portal.tree_equals(value, restored)
+    assert restored['large'].ctypes.data % 64 == 0
+
+  @pytest.mark.parametrize('fn, copies', [
+      (lambda x: x.T, False),
+      (lambda x: x.transpose(1, 0, 2), False),
+      (lambda x: x[:, ::2], False),
+      (lambda x: x[1:3, :, 4:], True),
+      (lambda x: x[::-1], False),
+      (lambda x: x[..., ::2], True),
+  ])
+  def test_strided(self, fn, copies):
+    base = np.arange(4 * 6 * 4096, dtype=np.float32).reshape(4, 6, 4096)
+    value = fn(base)
+    assert not value.flags.c_contiguous
+    buffers = portal.pack({'x': value})
+    shared = [
+        np.shares_memory(np.frombuffer(x, np.uint8), base)
+        for x in buffers if len(x) >= 1024]
+    assert shared and all(shared) != copies
+    restored = portal.unpack(b''.join(buffers))['x']
+    assert restored.shape == value.shape
+    assert (restored == value).all()
+
+  def test_sendfile(self, tmp_path):
+    data = np.arange(64 * 1024, dtype=np.float32).reshape(64, 1024)
+    np.save(tmp_path / 'data.npy', data)
+    mapped = np.load(tmp_path / 'data.npy', mmap_mode='r')
+    value = {'x': mapped[8:], 'y': mapped[:1], 'z': mapped[::2]}
+    buffers = portal.pack(value, sendfile=True)
+    ranges = [x for x in buffers if isinstance(x, portal.buffers.FileRange)]
+    assert len(ranges) == 1
+    assert ranges[0].length == data[8:].nbytes
+    buffer = b''.join(
+        x.memory() if isinstance(x, portal.buffers.FileRange) else x
+        for x in buffers)
+    restored = portal.unpack(buffer)
+    expected = {k: np.asarray(v) for k, v in value.items()}
+    assert portal.tree_equals(restored, expected)
+    assert b''.join(portal.pack(value)) == buffer
+
+  @pytest.mark.parametrize('blocksize', (4096, 40))
+  def test_pack_into(self, blocksize):
+    value = {'a': 12, 'b': 'hello', 'c': np.arange(10)}
+    block = bytearray(blocksize)
+    block[:3] = b'abc'
+    buffers = portal.pack_into(block, value, 3)
+    assert bytes(buffers[0][:3]) == b'abc'
+    assert (buffers[0].obj is block) == (blocksize == 4096)
+    buffer = b''.join(buffers)
+    expected = {**value, 'a': np.asarray(12)}
+    assert portal.tree_equals(portal.unpack(buffer[3:]), expected)
+    assert buffer[3:] == b''.join(portal.pack(value, offset=3))
+
+  def test_lazy(self):
+    value = {
+        'route': 'train', 'step': 12,
+        'obs': {'image': np.zeros((4, 8, 8), np.uint8), 'vec': np.arange(3)},
+        'items': [1, [2, 'three'], []], 'pair': [np.ones(2), None],
+        'frames': [np.full(3, i) for i in range(20)],
+    }
+    expected = portal.packlib.tree_map(
+        lambda x: np.asarray(x) if type(x) is int else x, value)
+    buffer = b''.join(portal.pack(value, compress='zlib', compress_min=1))
+    result = portal.unpack(buffer, lazy=True)
+    assert isinstance(result, portal.packlib.LazyDict)
+    assert list(result.keys()) == list(value.keys())
+    assert result['route'] == 'train'
+    assert result['obs']['vec'].tolist() == [0, 1, 2]
+    assert result['items'][1][1] == 'three'
+    assert len(result['items'][-1]) == 0
+    assert result['pair'][1] is None
+    assert len(result['frames']) == 20
+    assert result['obs'] is result['obs']
+    assert portal.tree_equals(result.materialize(), expected)
+    assert portal.tree_equals(result['obs'].materialize(), value['obs'])
+    forwarded = portal.unpack(b''.join(portal.pack(result)))
+    assert portal.tree_equals(forwarded, expected)
+    assert portal.unpack(b''.join(portal.pack(42)), lazy=True) == 42
+
+  def test_delta(self):
+    encoder = portal.packlib.DeltaEncoder()
+    decoder = portal.packlib.DeltaDecoder()
+    value = {'a': np.zeros((100, 1001), np.float32), 'b': np.ones(3)}
+    sizes = []
+    for rows in (0, 0, 1, 10, 100):
+      value['a'] = value['a'].copy()
+      value['a'][:rows] += 1
+      buffer = b''.join(portal.pack(value, delta=encoder))
+      sizes.append(len(buffer))
+      lazy = rows == 10
+      result = portal.unpack(buffer, lazy=lazy, delta=decoder)
+      result = result.materialize() if lazy else result
+      assert portal.tree_equals(result, value)
+    assert sizes[1] < sizes[2] < sizes[3] < sizes[4] <= sizes[0]
+    assert sizes[1] < 1000
+    value['a'][-1] += 1
+    buffer = b''.join(portal.pack(value, delta=encoder))
+    with pytest.raises(ValueError):
+      portal.unpack(buffer)
+    with pytest.raises(ValueError):
+      portal.unpack(buffer, delta=portal.packlib.DeltaDecoder())
+    encoder.reset()
+    buffer = b''.join(portal.pack(value, delta=encoder))
+    result = portal.unpack(buffer, delta=portal.packlib.DeltaDecoder())
+    assert portal.tree_equals(result, value)
+
+  def test_schema_cache(self):
+    first = {'foo': np.zeros((2, 4), np.float32), 'bar': 'hello'}
+    second = {'foo': np.ones((2, 4), np.float32), 'bar': 'world'}
+    swapped = {'bar': 'world', 'foo': np.ones((2, 4), np.float32)}
+    before = portal.packlib.schema_cache_info()
+    for value in (first, second, swapped, second):
+      restored = portal.unpack(b''.join(portal.pack(value)))
+      assert portal.tree_equals(value, restored)
+      assert list(restored.keys()) == list(value.keys())
+    after = portal.packlib.schema_cache_info()
+    assert after['encode'].hits - before['encode'].hits >= 2
+    assert after['decode'].hits - before['decode'].hits >= 2
+
+  @pytest.mark.parametrize('offset', (0, 3, 16, 61))
+  def test_aligned(self, offset):
+    value = {
+        'a': 'x', 'b': np.arange(5, dtype=np.uint8), 'c': b'hi',
+        'd': np.ones((3, 7), np.float32)}
+    buffer = b''.join(portal.pack(value, offset=offset))
+    recvbuf = np.empty(offset + len(buffer) + 64, np.uint8)
+    start = -recvbuf.ctypes.data % 64
+    recvbuf = recvbuf[start: start + offset + len(buffer)]
+    recvbuf[offset:] = np.frombuffer(buffer, np.uint8)
+    restored = portal.unpack(memoryview(recvbuf.data)[offset:])
+    assert bytes(restored.pop('c')) == value.pop('c')
+    assert portal.tree_equals(value, restored)
+    for key in ('b', 'd'):
+      assert restored[key].ctypes.data % 64 == 0
+      assert restored[key].base is not None
+
+  def test_legacy_format(self):
+    treedef = msgpack.packb({'a': None, 'b': [None, None]})
+    specs = msgpack.packb([['utf8'], ['array', [2], '<i4'], ['none']])
+    buffers = [
+        treedef, specs, b'hi', np.array([1, 2], np.int32).tobytes(), b'\x00']
+    length = len(buffers).to_bytes(8, 'little')
+    sizes = struct.pack('<' + 'Q' * len(buffers), *[len(x) for x in buffers])
+    restored = portal.unpack(b''.join([length, sizes, *buffers]))
+    expected = {'a': 'hi', 'b': [np.array([1, 2], np.int32), None]}
+    assert portal.tree_equals(restored, expected)
+
+  def test_legacy_pack(self):
+    # Decodes like peers from before the versioned format.
+    def unpack(buffer):
+      length = int.from_bytes(buffer[:8], 'little', signed=False)
+      buffer = buffer[8:]
+      sizes = struct.unpack('<' + ('Q' * length), buffer[:8 * length])
+      buffer = buffer[8 * length:]
+      limits = np.cumsum(sizes)
+      buffers = [buffer[i: j] for i, j in zip([0, *limits[:-1]], limits)]
+      treedef, specs, *buffers = buffers
+      specs = msgpack.unpackb(specs)
+      leaves = []
+      for spec, buffer in zip(specs, buffers):
+        if spec[0] == 'none':
+          leaves.append(None)
+        elif spec[0] == 'utf8':
+          leaves.append(bytes(buffer).decode('utf-8'))
+        elif spec[0] == 'bytes':
+          leaves.append(buffer)
+        else:
+          assert spec[0] == 'array' and len(spec) == 3, spec
+          shape, dtype = spec[1:]
+          leaves.append(np.frombuffer(buffer, dtype).reshape(shape))
+      return portal.packlib.tree_unflatten(
+          leaves, portal.packlib.tree_flatten(msgpack.unpackb(treedef))[1])
+    value = {
+        'a': 'hi', 'b': [3, 1.5, None], 'c': b'bytes',
+        'd': np.arange(12, dtype=np.float32).reshape(3, 4).T,
+        'e': [np.ones(2, np.int8)] * 20}
+    block = bytearray(4)
+    buffer = b''.join(portal.pack_into(block, value, 4, version=0))[4:]
+    expected = {
+        **value, 'b': [np.asarray(3), np.asarray(1.5), None],
+        'd': np.ascontiguousarray(value['d'])}
+    assert portal.tree_equals(unpack(buffer), expected)
+    assert portal.tree_equals(portal.unpack(buffer), expected)
+
   def test_sharray(self):
     content = np.arange(6, dtype=np.float32).reshape(3, 2)
     value = portal.SharedArray((3, 2), np.float32)
@@ -45,6 +45,147 @@ class TestServer:
       assert result['foo'] == 2
       client.close()
 
+  @pytest.mark.parametrize('Server', SERVERS)
+  def test_aligned_arrays(self, Server):
+    def fn(name, x):
+      assert x.ctypes.data % 64 == 0
+      return x, x[1:]
+    port = portal.free_port()
+    server = Server(port)
+    server.bind('fn', fn)
+    with server:
+      client = portal.Client(port)
+      for name in ('a', 'bc', 'def'):
+        x, y = client.fn(name, np.arange(9, dtype=np.int16)).result()
+        assert x.ctypes.data % 64 == 0
+        assert (y == np.arange(1, 9)).all()
+      client.close()
+
+  @pytest.mark.parametrize('Server', SERVERS)
+  def test_compress(self, Server):
+    data = np.zeros((256, 1024), np.float32)
+    port = portal.free_port()
+    server = Server(port, compress='zlib')
+    server.bind('fn', lambda x: x + 1)
+    with server:
+      client = portal.Client(port, compress='zlib', compress_min=1024)
+      result = client.fn(data).result()
+      assert result.shape == data.shape
+      assert (result == 1).all()
+      client.close()
+
+  def test_lazy(self):
+    def fn(data):
+      assert isinstance(data['meta'], portal.packlib.LazyDict)
+      return data['meta']['route'], data['meta'].materialize()
+    port = portal.free_port()
+    server = portal.Server(port)
+    server.bind('fn', fn, lazy=True)
+    with server:
+      client = portal.Client(port)
+      data = {'meta': {'route': 'a', 'id': 3}, 'obs': np.zeros(1000)}
+      route, meta = client.fn(data).result()
+      assert route == 'a'
+      assert meta == {'route': 'a', 'id': 3}
+      client.close()
+
+  @pytest.mark.parametrize('Server', SERVERS)
+  def test_delta(self, Server):
+    port = portal.free_port()
+    server = Server(port)
+    server.bind('fn', lambda x, i: x.sum() + i)
+    with server:
+      client = portal.Client(port, delta=True)
+      data = np.zeros((256, 1024), np.float32)
+      futures = []
+      for i in range(5):
+        data = data.copy()
+        data[i] = 1
+        futures.append(client.fn(data, i))
+      results = [future.result() for future in futures]
+      assert results == [1024 * (i + 1) + i for i in range(5)]
+      client.close()
+
+  @pytest.mark.parametrize('Server', SERVERS)
+  def test_legacy_version(self, Server):
+    port = portal.free_port()
+    server = Server(port, version=0)
+    server.bind('fn', lambda x, y: (x.sum(), y))
+    with server:
+      # Messages in the original format are understood by either side.
+      for version in (0, portal.packlib.VERSION):
+        client = portal.Client(port, version=version)
+        data = np.arange(100, dtype=np.float32).reshape(10, 10).T
+        total, text = client.fn(data, 'foo').result()
+        assert total == data.sum() and text == 'foo'
+        client.close()
+
+  @pytest.mark.parametrize('Server', SERVERS)
+  def test_unix(self, Server, tmp_path):
+    addr = f'unix://{tmp_path}/server.sock'
+    server = Server(addr)
+    server.bind('fn', lambda x: 2 * x)
+    with server:
+      client = portal.Client(addr)
+      assert client.fn(21).result() == 42
+      assert (client.fn(np.arange(3)).result() == [0, 2, 4]).all()
+      client.close()
+
+  @pytest.mark.parametrize('Server', SERVERS)
+  def test_shmem(self, Server, tmp_path):
+    addr = f'shm://{tmp_path}/server.sock'
+    server = Server(addr, ring_size=1024 ** 2)
+    server.bind('fn', lambda x: 2 * x)
+    with server:
+      clients = [portal.Client(addr) for _ in range(3)]
+      data = np.arange(100000, dtype=np.float32)
+      for _ in range(5):
+        futures = [client.fn(data) for client in clients]
+        assert all((x.result() == 2 * data).all() for x in futures)
+      assert clients[0].fn(21).result() == 42
+      [x.close() for x in clients]
+
+  @pytest.mark.parametrize('addr', ('tcp', 'unix'))
+  def test_sendfile(self, addr, tmp_path):
+    data = np.arange(1024 ** 2, dtype=np.float32).reshape(1024, 1024)
+    np.save(tmp_path / 'data.npy', data)
+    mapped = np.load(tmp_path / 'data.npy', mmap_mode='r')
+    if addr == 'unix':
+      addr = f'unix://{tmp_path}/server.sock'
+    else:
+      addr = portal.free_port()
+    server = portal.Server(addr, sendfile=True)
+    server.bind('fn', lambda x, i: (x.sum(), mapped[i:]))
+    with server:
+      client = portal.Client(addr, sendfile=True)
+      for i in (0, 3, 1000):
+        total, rows = client.fn(mapped[i:], i).result()
+        assert total == data[i:].sum()
+        assert type(rows) is np.ndarray
+        assert (rows == data[i:]).all()
+      client.close()
+
+  @pytest.mark.parametrize('Server', SERVERS)
+  def test_streams(self, Server):
+    port = portal.free_port()
+    server = Server(port)
+    server.bind('fn', lambda x: (x.sum(), x))
+    with server:
+      client = portal.Client(port, streams=3)
+      # Large requests are striped over the connections while small ones
+      # are sent over one of them.
+      size = 3 * portal.buffers.STRIPE_MIN_SIZE // 4 + 1
+      futures = []
+      for i in range(4):
+        data = np.full(size * (i + 1), i, np.float32)
+        futures.append((data, client.fn(data)))
+        futures.append((np.int64(i), client.fn(np.int64(i))))
+      for data, future in futures:
+        total, result = future.result()
+        assert total == data.sum()
+        assert (result == data).all()
+      client.close()
+
   @pytest.mark.parametrize('Server', SERVERS)
   def test_multiple_clients(self, Server):
     port = portal.free_port()
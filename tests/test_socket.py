@@ -1,5 +1,7 @@
+import socket
 import time
 
+import numpy as np
 import pytest
 import portal
 
@@ -20,6 +22,192 @@ class TestSocket:
     server.close()
     client.close()
 
+  def test_unix(self, tmp_path):
+    addr = f'unix://{tmp_path}/test.sock'
+    server = portal.ServerSocket(addr)
+    clients = [portal.ClientSocket(addr) for _ in range(2)]
+    clients[0].send(b'foo')
+    clients[1].send(b'bar', b'baz')
+    received = dict(server.recv() for _ in range(2))
+    assert sorted(bytes(x) for x in received.values()) == [b'barbaz', b'foo']
+    assert len(server.connections) == 2
+    for addr, data in received.items():
+      server.send(addr, bytes(data)[::-1])
+    assert clients[0].recv() == b'oof'
+    assert clients[1].recv() == b'zabrab'
+    [x.close() for x in clients]
+    server.close()
+
+  @pytest.mark.parametrize('scheme', ('unix', 'shm'))
+  def test_stale_socket(self, tmp_path, scheme):
+    Server = dict(
+        unix=portal.ServerSocket, shm=portal.ShmemServerSocket)[scheme]
+    path = tmp_path / 'test.sock'
+    # A socket file left over from a previous server is replaced.
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(path))
+    stale.close()
+    Server(f'{scheme}://{path}').close()
+    # Other files are kept.
+    path.write_text('data')
+    with pytest.raises(FileExistsError):
+      Server(f'{scheme}://{path}')
+    assert path.read_text() == 'data'
+
+  @pytest.mark.parametrize('loops', (1, 3))
+  def test_loops(self, loops):
+    port = portal.free_port()
+    server = portal.ServerSocket(port, loops=loops)
+    clients = [portal.ClientSocket(port) for _ in range(8)]
+    for i, client in enumerate(clients):
+      client.send(bytes([i]) * (i + 1))
+    received = dict(server.recv() for _ in range(len(clients)))
+    assert len(server.connections) == len(clients)
+    for addr, data in received.items():
+      server.send(addr, bytes(data) * 2)
+    for i, client in enumerate(clients):
+      assert client.recv() == bytes([i]) * 2 * (i + 1)
+    [x.close() for x in clients]
+    server.close()
+
+  def test_send_across_loops(self):
+    port = portal.free_port()
+    server = portal.ServerSocket(port, loops=3, max_send_queue=10000)
+    clients = [
+        portal.ClientSocket(port, max_recv_queue=1000) for _ in range(6)]
+    for i, client in enumerate(clients):
+      client.send(bytes([i]))
+    received = [server.recv(timeout=10) for _ in clients]
+    addrs = {bytes(data)[0]: addr for addr, data in received}
+    assert len({server.conns[x].shard for x in addrs.values()}) == 3
+    # Threads enqueue messages while the connections are served by the loops
+    # of other threads.
+    def sender(addr, index):
+      for j in range(500):
+        server.send(addr, bytes([index]), j.to_bytes(4, 'little'))
+    threads = [
+        portal.Thread(sender, addr, index, start=True)
+        for index, addr in addrs.items()]
+    for i, client in enumerate(clients):
+      for j in range(500):
+        assert client.recv(timeout=10) == bytes([i]) + j.to_bytes(4, 'little')
+    [x.join() for x in threads]
+    sending = lambda: any(shard.sending() for shard in server.shards)
+    deadline = time.time() + 10
+    while (server.numsending or sending()) and time.time() < deadline:
+      time.sleep(0.01)
+    assert server.numsending == 0
+    assert not sending()
+    [x.close() for x in clients]
+    server.close()
+
+  def test_blocked_resume(self):
+    port = portal.free_port()
+    server = portal.ServerSocket(port)
+    # The client stops reading once it holds one message, so the socket
+    # buffers fill up and the server has to wait for the socket.
+    client = portal.ClientSocket(port, max_recv_bytes=1)
+    client.send(b'hi')
+    addr, _ = server.recv(timeout=10)
+    data = bytes(1024 ** 2)
+    for _ in range(32):
+      server.send(addr, data)
+    shard = server.conns[addr].shard
+    deadline = time.time() + 10
+    while not shard.blocked and time.time() < deadline:
+      time.sleep(0.01)
+    assert server.conns[addr] in shard.blocked
+    # Reading makes the socket writable again, which resumes sending.
+    for _ in range(32):
+      assert len(client.recv(timeout=10)) == len(data)
+    deadline = time.time() + 10
+    while server.numsending and time.time() < deadline:
+      time.sleep(0.01)
+    assert server.numsending == 0
+    assert not shard.blocked and not shard.ready
+    assert server.sendbudget.used == 0
+    client.close()
+    server.close()
+
+  def test_send_after_disconnect(self):
+    port = portal.free_port()
+    server = portal.ServerSocket(port)
+    client = portal.ClientSocket(port)
+    client.send(b'hi')
+    addr, _ = server.recv(timeout=10)
+    client.close()
+    # Messages that are enqueued around the disconnect are dropped without
+    # leaving the connection marked as sending.
+    deadline = time.time() + 10
+    while server.connections and time.time() < deadline:
+      server.send(addr, bytes(1024))
+    assert not server.connections
+    server.send(addr, b'dropped')
+    # The loop drops messages that reached the connection after it closed.
+    sending = lambda: any(shard.sending() for shard in server.shards)
+    deadline = time.time() + 10
+    while (server.numsending or sending()) and time.time() < deadline:
+      time.sleep(0.01)
+    assert server.numsending == 0
+    assert server.sendbudget.used == 0
+    assert not sending()
+    server.close()
+
+  @pytest.mark.parametrize('ring_size', (4096, 1024 ** 2))
+  def test_shmem(self, tmp_path, ring_size):
+    addr = f'shm://{tmp_path}/test.sock'
+    server = portal.ShmemServerSocket(addr, ring_size=ring_size)
+    client = portal.ShmemClientSocket(addr)
+    # Messages larger than half the ring are sent in multiple frames while the
+    # server reads them, so the server echoes from a separate thread.
+    messages = [bytes([i]) * (i * 997 % 20000 + 1) for i in range(100)]
+    def echo():
+      for _ in messages:
+        addr, data = server.recv()
+        server.send(addr, bytes(data)[::-1])
+    thread = portal.Thread(echo, start=True)
+    for message in messages:
+      client.send(message[:5], message[5:])
+    for message in messages:
+      assert client.recv() == message[::-1]
+    thread.join()
+    # Large messages are unpacked as views into the ring.
+    data = np.arange(50000, dtype=np.int32)
+    if data.nbytes < ring_size // 2:
+      client.send(data.data)
+      _, result = server.recv()
+      assert (np.frombuffer(result, np.int32) == data).all()
+    client.close()
+    server.close()
+
+  def test_shmem_backpressure(self, tmp_path):
+    addr = f'shm://{tmp_path}/test.sock'
+    server = portal.ShmemServerSocket(addr, ring_size=4096)
+    # A raw connection that never reads from its ring.
+    stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stalled.connect(f'{tmp_path}/test.sock')
+    socket.recv_fds(stalled, 8, 1)
+    client = portal.ShmemClientSocket(addr)
+    client.send(b'hello')
+    other, _ = server.recv(timeout=10)
+    stalled_addr, = [x for x in server.connections if x != other]
+    # Messages that do not fit into the ring are queued instead of blocking.
+    done = []
+    for i in range(10):
+      server.send(stalled_addr, bytes(1000), ondone=lambda: done.append(1))
+    assert 0 < len(done) < 10
+    server.send(other, b'world')
+    assert client.recv(timeout=10) == b'world'
+    # Queued messages are dropped once the client disconnects.
+    stalled.close()
+    deadline = time.time() + 10
+    while len(done) < 10 and time.time() < deadline:
+      time.sleep(0.01)
+    assert len(done) == 10
+    assert not server.waiting
+    client.close()
+    server.close()
+
   def test_multi_buffer(self):
     port = portal.free_port()
     server = portal.ServerSocket(port)
@@ -32,6 +220,17 @@ class TestSocket:
     server.close()
     client.close()
 
+  def test_many_buffers(self):
+    port = portal.free_port()
+    server = portal.ServerSocket(port)
+    client = portal.ClientSocket(port)
+    parts = [bytes([i % 256]) for i in range(5000)]
+    client.send(*parts)
+    addr, data = server.recv()
+    assert data == b''.join(parts)
+    server.close()
+    client.close()
+
   def test_multiple_send(self):
     port = portal.free_port()
     server = portal.ServerSocket(port)
@@ -53,6 +252,225 @@ class TestSocket:
     server.close()
     client.close()
 
+  def test_many_messages(self):
+    port = portal.free_port()
+    server = portal.ServerSocket(port)
+    client = portal.ClientSocket(
+        port, max_send_queue=1000, max_recv_queue=1000)
+    messages = [bytes([i % 256]) * (1 + i % 7) for i in range(1000)]
+    for message in messages:
+      client.send(message[:1], message[1:] or b'x')
+    received = [bytes(server.recv()[1]) for _ in messages]
+    assert received == [x[:1] + (x[1:] or b'x') for x in messages]
+    addr = server.connections[0]
+    for message in messages:
+      server.send(addr, message)
+    assert [client.recv() for _ in messages] == messages
+    server.close()
+    client.close()
+
+  def test_mixed_sizes(self):
+    port = portal.free_port()
+    server = portal.ServerSocket(port)
+    client = portal.ClientSocket(port)
+    sizes = [1, 3, 16 * 1024, 16 * 1024 + 1, 70000, 5, 1024 ** 2, 2, 60000]
+    messages = [bytes([i]) * size for i, size in enumerate(sizes)]
+    for message in messages:
+      client.send(message)
+    for message in messages:
+      addr, data = server.recv()
+      assert data == message
+      server.send(addr, data)
+    for message in messages:
+      assert client.recv() == message
+    server.close()
+    client.close()
+
+  def test_budgets(self):
+    port = portal.free_port()
+    budget = 2 * 1024 ** 2
+    server = portal.ServerSocket(port, max_recv_bytes=budget)
+    client = portal.ClientSocket(port, max_send_bytes=budget)
+    data = bytes(1024 ** 2)
+    sent = 0
+    with pytest.raises(TimeoutError):
+      while True:
+        client.send(data, timeout=1)
+        sent += 1
+    # The server stops reading once its budget is full, so that the remaining
+    # messages wait in the socket buffers and the send queue of the client.
+    time.sleep(0.5)
+    assert server.recvq.qsize() < sent
+    assert server.recvbudget.used <= budget + len(data)
+    for _ in range(sent):
+      assert len(server.recv()[1]) == len(data)
+    assert server.recvbudget.used == 0
+    client.send(data, timeout=1)
+    assert len(server.recv()[1]) == len(data)
+    server.close()
+    client.close()
+
+  def test_zerocopy(self):
+    port = portal.free_port()
+    server = portal.ServerSocket(port, zerocopy=True, zerocopy_min=1024)
+    client = portal.ClientSocket(port, zerocopy=True, zerocopy_min=1024)
+    data = np.arange(4 * 1024 ** 2, dtype=np.uint8)
+    for i in range(3):
+      client.send(b'head', data[i:].data, b'tail')
+      addr, result = server.recv(timeout=10)
+      assert result == b'head' + data[i:].tobytes() + b'tail'
+      # Responses are larger than the minimum size, so the first one is sent
+      # with MSG_ZEROCOPY and the connection must survive its completion.
+      server.send(addr, data[i:].data)
+      assert client.recv(timeout=10) == data[i:].tobytes()
+    assert server.connections == (addr,)
+    # The loopback interface copies the data on delivery, after which the
+    # sockets fall back to normal writes.
+    sockets = (client, server.conns[addr])
+    for stats in [x.zerocopy.stats() for x in sockets]:
+      if stats['sends']:
+        assert stats['copies'] and not stats['enabled']
+    server.close()
+    client.close()
+
+  @pytest.mark.parametrize('chunk_size', (0, 64 * 1024))
+  def test_chunks(self, chunk_size):
+    port = portal.free_port()
+    server = portal.ServerSocket(port, chunk_size=chunk_size)
+    client = portal.ClientSocket(
+        port, chunk_size=chunk_size, max_recv_queue=1024)
+    large = np.arange(64 * 1024 ** 2, dtype=np.uint8)
+    client.send(large.data)
+    for i in range(3):
+      client.send(b'small', i.to_bytes(1, 'little'))
+    received = [bytes(server.recv()[1][:6]) for _ in range(4)]
+    if chunk_size:
+      assert received[:3] == [b'small\x00', b'small\x01', b'small\x02']
+    else:
+      assert received[1:] == [b'small\x00', b'small\x01', b'small\x02']
+    addr = server.connections[0]
+    server.send(addr, large.data, b'tail')
+    server.send(addr, b'small')
+    results = [bytes(client.recv()) for _ in range(2)]
+    assert results[1 if chunk_size else 0] == large.tobytes() + b'tail'
+    assert results[0 if chunk_size else 1] == b'small'
+    server.close()
+    client.close()
+
+  def test_priorities(self):
+    sender, receiver = socket.socketpair()
+    sender.setblocking(False)
+    receiver.setblocking(False)
+    queue = portal.buffers.SendQueue()
+    large = bytes(range(256)) * 4096
+    chunksize = 64 * 1024
+    queue.append(portal.buffers.SendBuffer(large, chunksize=chunksize))
+    queue.append(portal.buffers.SendBuffer(b'low', priority=-1))
+    queue.append(portal.buffers.SendBuffer(b'high', priority=1))
+    queue.append(portal.buffers.SendBuffer(b'normal'))
+    recvbuf = portal.buffers.RecvStream(maxsize=len(large))
+    results = []
+    while len(results) < 4:
+      if queue:
+        try:
+          portal.buffers.sendmany(sender, queue)
+        except BlockingIOError:
+          pass
+      try:
+        recvbuf.recv(receiver)
+      except BlockingIOError:
+        pass
+      results += [bytes(x) for x in recvbuf.results()]
+    assert results == [b'high', b'normal', b'low', large]
+    assert not queue and not recvbuf.partials
+    # Messages that arrive while a frame is partially written wait until the
+    # end of that frame, regardless of their priority.
+    for chunksize in (0, chunksize):
+      queue.append(portal.buffers.SendBuffer(large, chunksize=chunksize))
+      with pytest.raises(BlockingIOError):
+        while True:
+          portal.buffers.sendmany(sender, queue)
+      assert queue.current is not None
+      queue.append(portal.buffers.SendBuffer(b'PING', priority=1))
+      results = []
+      while len(results) < 2:
+        if queue:
+          try:
+            portal.buffers.sendmany(sender, queue)
+          except BlockingIOError:
+            pass
+        try:
+          recvbuf.recv(receiver)
+        except BlockingIOError:
+          pass
+        results += [bytes(x) for x in recvbuf.results()]
+      if chunksize:
+        assert results == [b'PING', large]
+      else:
+        assert results == [large, b'PING']
+      assert not queue and not recvbuf.partials
+    sender.close()
+    receiver.close()
+
+  def test_pool(self):
+    port = portal.free_port()
+    server = portal.ServerSocket(port, pool_max_bytes=64 * 1024 ** 2)
+    client = portal.ClientSocket(port)
+    data = bytes(range(256)) * 4096
+    for _ in range(3):
+      client.send(data)
+      _, result = server.recv()
+      assert result == data
+      del result
+    stats = server.pool.stats()
+    assert (stats['allocs'], stats['reuses']) == (1, 2)
+    assert (stats['inuse'], stats['pooled']) == (0, len(data))
+    # The buffer is not reused while a view into it is still alive.
+    client.send(data)
+    view = np.frombuffer(server.recv()[1], np.uint8)[16:]
+    client.send(data)
+    _, result = server.recv()
+    assert server.pool.stats()['allocs'] == 2
+    assert (view == np.frombuffer(data, np.uint8)[16:]).all()
+    del view, result
+    assert server.pool.stats()['pooled'] == 2 * len(data)
+    server.close()
+    client.close()
+
+  def test_pool_default(self):
+    port = portal.free_port()
+    server = portal.ServerSocket(port)
+    client = portal.ClientSocket(port)
+    data = bytes(range(256)) * 4096
+    client.send(data)
+    assert server.recv()[1] == data
+    # Buffers are not kept after the message has been released.
+    stats = server.pool.stats()
+    assert (stats['allocs'], stats['pooled']) == (0, 0)
+    server.close()
+    client.close()
+
+  def test_stripes(self):
+    data = bytes(range(256)) * 64
+    budget = portal.buffers.Budget()
+    connections = {'a', 'b'}
+    stripes = portal.buffers.Stripes(
+        len(data), budget, lambda: connections, timeout=60)
+    first, second = portal.buffers.stripes([data], 2, 1, 0)
+    assert stripes.add('a', b''.join(first)) is None
+    assert budget.used == len(data) // 2
+    assert bytes(stripes.add('b', b''.join(second))) == data
+    assert budget.used == 0
+    # Partial requests are dropped when a connection that delivered one of
+    # their stripes closes.
+    assert stripes.add('a', b''.join(first)) is None
+    connections.remove('a')
+    stripes.expire()
+    assert not stripes.partials and budget.used == 0
+    with pytest.raises(ValueError):
+      large = portal.buffers.stripes([data + b'x'], 2, 1, 1)
+      stripes.add('b', b''.join(large[0]))
+
   @pytest.mark.parametrize('repeat', range(3))
   def test_disconnect_server(self, repeat):
     port = portal.free_port()
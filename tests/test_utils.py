@@ -0,0 +1,41 @@
+import os
+import selectors
+
+import pytest
+import portal
+
+
+class TestUtils:
+
+  @pytest.mark.parametrize('eventfd', (True, False))
+  def test_notifier(self, monkeypatch, eventfd):
+    if not eventfd:
+      monkeypatch.delattr(os, 'eventfd', raising=False)
+    elif not hasattr(os, 'eventfd'):
+      pytest.skip('Platform has no eventfd')
+    notifier = portal.utils.Notifier()
+    assert notifier.eventfd == eventfd
+    sel = selectors.DefaultSelector()
+    sel.register(notifier, selectors.EVENT_READ)
+    assert not sel.select(timeout=0)
+    # Notifications are coalesced into a single write until cleared.
+    for _ in range(100):
+      notifier.set()
+    assert sel.select(timeout=0)
+    if eventfd:
+      assert os.eventfd_read(notifier.fileno()) == 1
+    else:
+      assert os.read(notifier.fileno(), 4096) == bytes(1)
+    notifier.set()
+    assert not sel.select(timeout=0)
+    notifier.clear()
+    assert not sel.select(timeout=0)
+    # A notification after clearing wakes up the loop again.
+    for _ in range(2):
+      for _ in range(10):
+        notifier.set()
+      assert sel.select(timeout=0)
+      notifier.clear()
+      assert not sel.select(timeout=0)
+    sel.close()
+    notifier.close()